@@ -0,0 +1,360 @@
+"""Shawl color classification.
+
+The rules map an RGB sample to one of the ColorName values through its HSV
+coordinates. They exist twice: `classify_hsv` is the readable reference
+version, and `classify_rgb_array` is the same ladder vectorized with NumPy.
+The vectorized rules are used to precompute a lookup table covering every
+24-bit RGB value, so classifying a sample (or a whole frame of them) is a
+single array index.
+"""
+from __future__ import annotations
+
+import hashlib
+import inspect
+import io
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+# NumPy is imported by the functions that use it, keeping it off the cold
+# start path: the scalar rules and COLOR_NAMES don't need it
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Order matters: the lookup table stores indexes into this tuple
+COLOR_NAMES = (
+    "black", "white", "grey", "light_grey", "dark_grey",
+    "red", "light_red", "dark_red", "orange", "brown",
+    "yellow", "light_yellow", "green", "light_green", "dark_green",
+    "blue", "light_blue", "dark_blue", "purple", "light_purple",
+    "dark_purple", "pink", "light_pink", "maroon", "navy",
+    "teal", "olive", "beige", "cream",
+)
+COLOR_INDEX = {name: index for index, name in enumerate(COLOR_NAMES)}
+
+
+def rgb_to_hsv(r: int, g: int, b: int):
+    """Convert 0-255 RGB values to hue in degrees and saturation/value in 0-1"""
+    r_norm, g_norm, b_norm = r/255.0, g/255.0, b/255.0
+    max_val = max(r_norm, g_norm, b_norm)
+    min_val = min(r_norm, g_norm, b_norm)
+    diff = max_val - min_val
+
+    if diff == 0:
+        hue = 0
+    elif max_val == r_norm:
+        hue = (60 * ((g_norm - b_norm) / diff) + 360) % 360
+    elif max_val == g_norm:
+        hue = (60 * ((b_norm - r_norm) / diff) + 120) % 360
+    else:
+        hue = (60 * ((r_norm - g_norm) / diff) + 240) % 360
+
+    saturation = 0 if max_val == 0 else diff / max_val
+    value = max_val
+    return hue, saturation, value
+
+
+def classify_hsv(hue: float, saturation: float, value: float) -> str:
+    """Name the color at the given HSV coordinates"""
+    if value < 0.15:
+        return "black"
+    if saturation < 0.1:
+        if value > 0.9:
+            return "white"
+        elif value > 0.6:
+            return "light_grey"
+        elif value > 0.3:
+            return "grey"
+        return "dark_grey"
+
+    # Color detection based on hue ranges
+    if 0 <= hue < 15 or 345 <= hue < 360:
+        return "dark_red" if value < 0.5 else ("light_red" if value > 0.8 and saturation < 0.7 else "red")
+    elif 15 <= hue < 45:
+        return "orange" if saturation > 0.5 else "brown"
+    elif 45 <= hue < 75:
+        return "light_yellow" if value > 0.8 else "yellow"
+    elif 75 <= hue < 150:
+        return "light_green" if value > 0.7 and saturation < 0.6 else ("dark_green" if value < 0.4 else "green")
+    elif 150 <= hue < 210:
+        return "light_blue" if value > 0.7 and saturation < 0.6 else ("dark_blue" if value < 0.4 else "blue")
+    elif 210 <= hue < 270:
+        return "light_purple" if value > 0.7 and saturation < 0.6 else ("dark_purple" if value < 0.4 else "purple")
+    elif 270 <= hue < 330:
+        return "light_pink" if value > 0.8 and saturation < 0.5 else "pink"
+    return "maroon" if value < 0.4 else "red"
+
+
+def classify_rgb(r: int, g: int, b: int) -> str:
+    """Name the color of a single RGB sample using the reference rules"""
+    return classify_hsv(*rgb_to_hsv(r, g, b))
+
+
+def rgb_to_hsv_array(rgb: np.ndarray):
+    """Vectorized rgb_to_hsv over an (n, 3) array, bit-for-bit identical to it"""
+    import numpy as np
+    norm = rgb.astype(np.float64) / 255.0
+    r_norm, g_norm, b_norm = norm[:, 0], norm[:, 1], norm[:, 2]
+    max_val = norm.max(axis=1)
+    diff = max_val - norm.min(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hue = np.select(
+            [diff == 0, max_val == r_norm, max_val == g_norm],
+            [
+                0.0,
+                np.mod(60 * ((g_norm - b_norm) / diff) + 360, 360),
+                np.mod(60 * ((b_norm - r_norm) / diff) + 120, 360),
+            ],
+            np.mod(60 * ((r_norm - g_norm) / diff) + 240, 360),
+        )
+        saturation = np.where(max_val == 0, 0.0, diff / max_val)
+    return hue, saturation, max_val
+
+
+def classify_rgb_array(rgb: np.ndarray) -> np.ndarray:
+    """Vectorized classify_rgb: COLOR_NAMES indexes for an (n, 3) array of samples"""
+    import numpy as np
+    hue, sat, val = rgb_to_hsv_array(rgb)
+    grey = sat < 0.1
+    light = (val > 0.7) & (sat < 0.6)
+    dark = val < 0.4
+
+    # np.select takes the first matching condition, mirroring the if/elif ladder
+    rules = [
+        (val < 0.15, "black"),
+        (grey & (val > 0.9), "white"),
+        (grey & (val > 0.6), "light_grey"),
+        (grey & (val > 0.3), "grey"),
+        (grey, "dark_grey"),
+    ]
+    red = ((hue >= 0) & (hue < 15)) | ((hue >= 345) & (hue < 360))
+    rules += [
+        (red & (val < 0.5), "dark_red"),
+        (red & (val > 0.8) & (sat < 0.7), "light_red"),
+        (red, "red"),
+    ]
+    orange = (hue >= 15) & (hue < 45)
+    rules += [(orange & (sat > 0.5), "orange"), (orange, "brown")]
+    yellow = (hue >= 45) & (hue < 75)
+    rules += [(yellow & (val > 0.8), "light_yellow"), (yellow, "yellow")]
+    for low, high, name in ((75, 150, "green"), (150, 210, "blue"), (210, 270, "purple")):
+        band = (hue >= low) & (hue < high)
+        rules += [(band & light, f"light_{name}"), (band & dark, f"dark_{name}"), (band, name)]
+    pink = (hue >= 270) & (hue < 330)
+    rules += [
+        (pink & (val > 0.8) & (sat < 0.5), "light_pink"),
+        (pink, "pink"),
+        (dark, "maroon"),
+    ]
+
+    return np.select(
+        [condition for condition, _ in rules],
+        [COLOR_INDEX[name] for _, name in rules],
+        COLOR_INDEX["red"],
+    ).astype(np.uint8)
+
+
+# Lookup table
+# One uint8 per 24-bit RGB value (16 MiB). Building it takes a few seconds,
+# so it is cached on disk under a name derived from the rules' source code;
+# editing the rules changes the name and forces a rebuild.
+LUT_SIZE = 1 << 24
+RULES_VERSION = hashlib.sha256("".join(
+    inspect.getsource(function) for function in (rgb_to_hsv_array, classify_rgb_array)
+).encode() + "|".join(COLOR_NAMES).encode()).hexdigest()[:16]
+COLOR_LUT_PATH = Path(os.environ.get(
+    "COLOR_LUT_PATH",
+    Path(tempfile.gettempdir()) / f"shawl-color-lut-{RULES_VERSION}.npy"
+))
+
+_lut = None
+
+
+def rgb_keys(rgb: np.ndarray) -> np.ndarray:
+    """Pack an (n, 3) array of RGB samples into lookup table indexes"""
+    import numpy as np
+    rgb = rgb.astype(np.uint32)
+    return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+
+
+def build_color_lut() -> np.ndarray:
+    """Classify every 24-bit RGB value with the vectorized rules"""
+    import numpy as np
+    lut = np.empty(LUT_SIZE, dtype=np.uint8)
+    g, b = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    plane = np.stack([np.zeros(g.size, dtype=np.int64), g.ravel(), b.ravel()], axis=1)
+    # One red plane at a time keeps the float temporaries small
+    for r in range(256):
+        plane[:, 0] = r
+        lut[r << 16:(r + 1) << 16] = classify_rgb_array(plane)
+    return lut
+
+
+def verify_color_lut(lut: np.ndarray, samples: int = 20000, exhaustive: bool = False, seed: int = 0) -> int:
+    """Check the table against the reference rules, returning the number of disagreements.
+
+    By default this checks every value on a coarse lattice (including both
+    ends of each channel) plus a random sample; `exhaustive` checks all
+    16.7 million entries, which takes around a minute.
+    """
+    import numpy as np
+    if exhaustive:
+        keys = range(LUT_SIZE)
+    else:
+        lattice = np.arange(0, 256, 15).tolist() + [255]
+        rng = np.random.default_rng(seed)
+        keys = [(r << 16) | (g << 8) | b for r in lattice for g in lattice for b in lattice]
+        keys += rng.integers(0, LUT_SIZE, samples).tolist()
+
+    mismatches = 0
+    for key in keys:
+        if COLOR_NAMES[lut[key]] != classify_rgb(key >> 16, (key >> 8) & 0xFF, key & 0xFF):
+            mismatches += 1
+    return mismatches
+
+
+def load_color_lut() -> np.ndarray:
+    """Return the lookup table, loading it from the disk cache or building it"""
+    global _lut
+    import numpy as np
+    if _lut is not None:
+        return _lut
+
+    lut = None
+    if COLOR_LUT_PATH.exists():
+        try:
+            lut = np.load(COLOR_LUT_PATH, mmap_mode="r")
+            if lut.shape != (LUT_SIZE,) or verify_color_lut(lut, samples=2000):
+                logger.warning(f"Discarding stale color lookup table at {COLOR_LUT_PATH}")
+                lut = None
+        except (OSError, ValueError):
+            lut = None
+
+    if lut is None:
+        lut = build_color_lut()
+        mismatches = verify_color_lut(lut)
+        if mismatches:
+            raise RuntimeError(f"Color lookup table disagrees with the rules on {mismatches} samples")
+        try:
+            COLOR_LUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+            scratch = COLOR_LUT_PATH.with_name(f"{COLOR_LUT_PATH.stem}.{os.getpid()}.tmp.npy")
+            np.save(scratch, lut)
+            os.replace(scratch, COLOR_LUT_PATH)
+        except OSError as e:
+            logger.warning(f"Could not cache color lookup table: {e}")
+
+    _lut = lut
+    return _lut
+
+
+def color_lut_loaded() -> bool:
+    return _lut is not None
+
+
+def classify_rgb_lut(rgb: np.ndarray, load: bool = True) -> np.ndarray:
+    """COLOR_NAMES indexes for an (n, 3) array of samples, via the lookup table.
+
+    With load=False a table that isn't loaded yet is not loaded (or built)
+    here; the vectorized rules, which the table was built from, answer instead.
+    """
+    import numpy as np
+    if _lut is None and not load:
+        return classify_rgb_array(rgb)
+    return np.asarray(load_color_lut()[rgb_keys(rgb)])
+
+
+def classify_rgb_value(r: int, g: int, b: int) -> str:
+    """Name one RGB value from the lookup table, or the rules while it isn't loaded"""
+    if _lut is None:
+        return classify_rgb(r, g, b)
+    return COLOR_NAMES[_lut[(r << 16) | (g << 8) | b]]
+
+
+# Perceptual color space
+# sRGB (D65) -> CIE XYZ -> CIELAB, so that Euclidean distance approximates how
+# different two colors look (CIE76 delta E)
+SRGB_TO_XYZ = (
+    (0.4124564, 0.3575761, 0.1804375),
+    (0.2126729, 0.7151522, 0.0721750),
+    (0.0193339, 0.1191920, 0.9503041),
+)
+D65_WHITE = (0.95047, 1.0, 1.08883)
+
+
+def hex_to_rgb_array(hexes) -> np.ndarray:
+    """Parse "#rrggbb" strings into an (n, 3) array of 0-255 values"""
+    import numpy as np
+    return np.array([[int(h[i:i + 2], 16) for i in (1, 3, 5)] for h in hexes], dtype=np.float64).reshape(-1, 3)
+
+
+def rgb_to_lab_array(rgb: np.ndarray) -> np.ndarray:
+    """Convert an (n, 3) array of 0-255 sRGB values to CIELAB"""
+    import numpy as np
+    linear = rgb / 255.0
+    linear = np.where(linear <= 0.04045, linear / 12.92, ((linear + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ np.transpose(SRGB_TO_XYZ) / np.asarray(D65_WHITE)
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def hex_to_lab_array(hexes) -> np.ndarray:
+    """Convert "#rrggbb" strings to an (n, 3) array of CIELAB coordinates"""
+    return rgb_to_lab_array(hex_to_rgb_array(hexes))
+
+
+# Dominant colors
+class ImageTooLarge(ValueError):
+    """The image would decode to more than the allowed number of pixels"""
+
+
+def dominant_colors(image_bytes: bytes, k: int = 3, max_side: int = 96, max_pixels: int = 24_000_000):
+    """Find the k most common named colors in an encoded image.
+
+    The image is downsampled to at most max_side pixels on its longest edge,
+    every pixel is classified through the lookup table, and the histogram of
+    color names gives each color's share of the fabric. A color is reported
+    with the mean RGB of its pixels and its share as the confidence. Images
+    that would decode to more than max_pixels are rejected with ImageTooLarge
+    before any decoding. Runs in a worker process, so it only takes and
+    returns plain picklable values.
+    """
+    import numpy as np
+    # Imported here: only the image worker processes need Pillow
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        width, height = image.size
+        # JPEG decoders can downscale while decoding, which is far cheaper
+        # than decoding the full photo and resizing it afterwards
+        image.draft("RGB", (max_side, max_side))
+        # Only the header has been read: the size is what decoding would
+        # allocate (after any JPEG draft scaling), so a small compressed file
+        # of a huge PNG can't exhaust the worker's memory
+        if image.width * image.height > max_pixels:
+            raise ImageTooLarge(f"{width}x{height} pixels")
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        pixels = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+
+    names = classify_rgb_lut(pixels)
+    counts = np.bincount(names, minlength=len(COLOR_NAMES))
+    sums = np.zeros((len(COLOR_NAMES), 3))
+    np.add.at(sums, names, pixels)
+
+    results = []
+    for index in np.argsort(counts, kind="stable")[::-1][:k]:
+        if not counts[index]:
+            break
+        r, g, b = (int(round(channel)) for channel in sums[index] / counts[index])
+        results.append({
+            "hex": f"#{r:02x}{g:02x}{b:02x}",
+            "rgb": {"r": r, "g": g, "b": b},
+            "name": COLOR_NAMES[index],
+            "confidence": float(counts[index] / len(pixels)),
+        })
+    return {"colors": results, "width": width, "height": height, "sampledPixels": int(len(pixels))}
@@ -0,0 +1,107 @@
+"""Maintenance commands for the Shawl Scan & Sales backend.
+
+Run from the backend directory with the same environment as the API, e.g.
+
+    python manage.py rebuild-rollups
+    python manage.py check-indexes
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+async def rebuild_rollups(args):
+    """Recompute the dashboard sales rollups from all sales (safe while tills are selling)"""
+    try:
+        result = await server.rebuild_sales_rollups(batch_size=args.batch_size)
+    except server.HTTPException as e:
+        print(e.detail)
+        sys.exit(1)
+    print(f"Rebuilt {result['rollups']} rollups over {result['periods']} periods from {result['sales']} sales")
+
+
+async def backfill_search(args):
+    """Add search terms to products and sales stored before search indexing"""
+    updated = await server.backfill_search_terms(batch_size=args.batch_size)
+    print(f"Updated {updated['products']} products and {updated['sales']} sales")
+
+
+async def migrate_dates(args):
+    """Convert legacy ISO-string timestamps to native BSON dates (safe to rerun)"""
+    converted = await server.migrate_datetimes(batch_size=args.batch_size)
+    print(f"Converted {converted['products']} products and {converted['sales']} sales")
+
+
+async def archive_sales(args):
+    """Move sales older than --days into the archive (safe to rerun)"""
+    before = datetime.now(timezone.utc) - timedelta(days=args.days)
+    try:
+        archived = await server.archive_sales(before, batch_size=args.batch_size)
+    except server.HTTPException as e:
+        print(e.detail)
+        sys.exit(1)
+    print(f"Archived {archived} sales recorded before {before:%Y-%m-%d}")
+
+
+async def check_indexes(args):
+    """Create the API's indexes and verify every query is index-backed"""
+    await server.ensure_indexes()
+    report = await server.explain_indexed_queries()
+    for entry in report:
+        status = "ok  " if entry["indexBacked"] else "SCAN" if entry["collectionScan"] else "WIDE"
+        print(f"{status} {entry['collection']:<14} {entry['query']:<18} "
+              f"{entry['docsExamined']:>7} examined {entry['nReturned']:>5} returned  {' <- '.join(entry['stages'])}")
+    if not all(entry["indexBacked"] for entry in report):
+        sys.exit(1)
+
+
+async def verify_colors(args):
+    """Check the color lookup table agrees with the classification rules"""
+    lut = server.colors.load_color_lut()
+    mismatches = server.colors.verify_color_lut(lut, exhaustive=args.exhaustive)
+    print(f"{mismatches} disagreements between {server.colors.COLOR_LUT_PATH} and the rules")
+    if mismatches:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shawl Scan & Sales maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rollups = commands.add_parser("rebuild-rollups", help=rebuild_rollups.__doc__)
+    rollups.add_argument("--batch-size", type=int, default=1000)
+    rollups.set_defaults(handler=rebuild_rollups)
+
+    search = commands.add_parser("backfill-search", help=backfill_search.__doc__)
+    search.add_argument("--batch-size", type=int, default=500)
+    search.set_defaults(handler=backfill_search)
+
+    dates = commands.add_parser("migrate-dates", help=migrate_dates.__doc__)
+    dates.add_argument("--batch-size", type=int, default=1000)
+    dates.set_defaults(handler=migrate_dates)
+
+    archive = commands.add_parser("archive-sales", help=archive_sales.__doc__)
+    archive.add_argument("--days", type=int, default=server.SALES_ARCHIVE_AFTER.days)
+    archive.add_argument("--batch-size", type=int, default=1000)
+    archive.set_defaults(handler=archive_sales)
+
+    indexes = commands.add_parser("check-indexes", help=check_indexes.__doc__)
+    indexes.set_defaults(handler=check_indexes)
+
+    verify = commands.add_parser("verify-colors", help=verify_colors.__doc__)
+    verify.add_argument("--exhaustive", action="store_true", help="check all 16.7M RGB values (about a minute)")
+    verify.set_defaults(handler=verify_colors)
+
+    args = parser.parse_args()
+    server.connect_database()
+    try:
+        asyncio.run(args.handler(args))
+    finally:
+        server.client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,48 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File
+# Startup is timed from here, imports included (see startup_timings)
+import time
+STARTUP_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Query, Response, Header
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
-from datetime import datetime, timezone
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+import base64
+import functools
+import binascii
+import hashlib
+import csv
+import io
+import json
+from itertools import islice
+from contextlib import asynccontextmanager, contextmanager
+import re
+import asyncio
+from datetime import datetime, timezone, timedelta
 from enum import Enum
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from urllib.parse import quote_plus
+import orjson
+from pymongo import UpdateOne, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError
+from bson import ObjectId
+
+import colors
+import metrics
+import slow_queries
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -27,11 +59,84 @@ if 'MONGO_USERNAME' in os.environ and 'MONGO_PASSWORD' in os.environ:
     mongo_options = os.environ.get('MONGO_OPTIONS', '?retryWrites=true&w=majority&appName=Cluster0')
     mongo_url = f"mongodb+srv://{username}:{password}@{mongo_host}/{mongo_options}"
 
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Opt-in: commands slower than SLOW_QUERY_MS are kept, with explain plans,
+# for /api/admin/slow-queries
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0"))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", "200"))
+slow_query_log = slow_queries.SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE) if SLOW_QUERY_MS > 0 else None
+
+# Connection pool settings apply per worker process: with WEB_CONCURRENCY
+# workers the database sees up to WEB_CONCURRENCY * MONGO_MAX_POOL_SIZE
+# connections. Unset values keep the driver defaults.
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": "MONGO_MAX_POOL_SIZE",
+    "minPoolSize": "MONGO_MIN_POOL_SIZE",
+    "maxIdleTimeMS": "MONGO_MAX_IDLE_TIME_MS",
+    "waitQueueTimeoutMS": "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+    "connectTimeoutMS": "MONGO_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGO_SOCKET_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGO_SERVER_SELECTION_TIMEOUT_MS",
+}
+
+# Created by connect_database() when the app starts (or by a script that uses
+# the helpers directly), so every worker process builds its own client
+client = None
+db = None
+
+def connect_database():
+    """Create the Motor client and database handle, unless one was already set"""
+    global client, db
+    if client is not None:
+        return
+    pool_options = {option: int(os.environ[name]) for option, name in MONGO_POOL_OPTIONS.items() if os.environ.get(name)}
+    # tz_aware: stored dates come back as UTC-aware datetimes; the listeners
+    # time every command for /api/metrics and the slow query log
+    client = AsyncIOMotorClient(
+        mongo_url,
+        tz_aware=True,
+        event_listeners=[metrics.MongoCommandMetrics()] + ([slow_query_log] if slow_query_log else []),
+        **pool_options
+    )
+    db = client[os.environ['DB_NAME']]
+
+class FastJSONResponse(ORJSONResponse):
+    """orjson-encoded response; UTC datetimes end in "Z", as pydantic renders them"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+# Startup modes: "eager" warms everything up before serving; "lazy" (for
+# scale-to-zero hosting, where a cold start delays the first scan) starts
+# serving at once and warms up in the background or on first use
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "eager")
+# Lazy mode retries a failed warm-up after this many seconds, doubling up to the max
+WARM_UP_RETRY_DELAY = 1.0
+WARM_UP_RETRY_MAX_DELAY = 60.0
+startup_timings: Dict[str, float] = {}
+
+@contextmanager
+def startup_phase(name: str):
+    """Record how long a startup phase takes, in milliseconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def startup_elapsed() -> float:
+    return round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_app()
+    try:
+        yield
+    finally:
+        await stop_app()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -76,6 +181,33 @@ class ColorName(str, Enum):
     BEIGE = "beige"
     CREAM = "cream"
 
+assert {color.value for color in ColorName} == set(colors.COLOR_NAMES), "ColorName and colors.COLOR_NAMES are out of sync"
+
+class AnalyticsGranularity(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+
+class AnalyticsGroupBy(str, Enum):
+    PRODUCT = "productCode"
+    CATEGORY = "category"
+    COLOR = "colorAtSale"
+
+class JobKind(str, Enum):
+    REBUILD_ROLLUPS = "rebuild-rollups"
+    ARCHIVE_SALES = "archive-sales"
+    EXPORT_PRODUCTS = "export-products"
+    EXPORT_SALES = "export-sales"
+    IMPORT_PRODUCTS = "import-products"
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
 # Models
 class Product(BaseModel):
     code: str = Field(..., description="Unique product code")
@@ -118,6 +250,42 @@ class SaleCreate(BaseModel):
     productCode: str
     quantity: int = Field(default=1, gt=0)
 
+class CheckoutRequest(BaseModel):
+    items: List[SaleCreate] = Field(..., min_length=1, max_length=200)
+
+class QueuedSale(SaleCreate):
+    idempotencyKey: str = Field(..., min_length=1, max_length=100)
+    timestamp: Optional[datetime] = None
+
+class SaleSyncRequest(BaseModel):
+    sales: List[QueuedSale] = Field(..., min_length=1, max_length=500)
+
+class SaleSyncStatus(str, Enum):
+    RECORDED = "recorded"
+    DUPLICATE = "duplicate"
+    REJECTED = "rejected"
+
+class SaleSyncResult(BaseModel):
+    idempotencyKey: str
+    status: SaleSyncStatus
+    sale: Optional[Sale] = None
+    error: Optional[str] = None
+
+class DataFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+class ImportRowError(BaseModel):
+    row: int
+    code: Optional[str] = None
+    error: str
+
+class ImportReport(BaseModel):
+    received: int
+    inserted: int
+    failed: int
+    errors: List[ImportRowError]
+
 class ColorDetection(BaseModel):
     hex: str
     rgb: Dict[str, int]
@@ -125,197 +293,1821 @@ class ColorDetection(BaseModel):
     name: ColorName
     confidence: float
 
+class ColorSamples(BaseModel):
+    samples: List[List[int]] = Field(..., min_length=1, max_length=10000)
+
+class ColorBatchDetection(BaseModel):
+    names: List[ColorName]
+    hex: List[str]
+    counts: Dict[str, int]
+    dominant: ColorName
+
+class DominantColor(BaseModel):
+    hex: str
+    rgb: Dict[str, int]
+    name: ColorName
+    confidence: float
+
+class ImageColorDetection(BaseModel):
+    colors: List[DominantColor]
+    width: int
+    height: int
+    sampledPixels: int
+
+class SimilarProduct(Product):
+    deltaE: float
+
+class ProductChanges(BaseModel):
+    changed: List[Product]
+    removed: List[str]
+    token: str
+    reset: bool = False
+
+class JobProgress(BaseModel):
+    done: int = 0
+    total: Optional[int] = None
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    kind: JobKind
+    status: JobStatus = JobStatus.QUEUED
+    params: Dict[str, Any] = Field(default_factory=dict)
+    progress: JobProgress = Field(default_factory=JobProgress)
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    cancelRequested: bool = False
+    createdAt: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    startedAt: Optional[datetime] = None
+    finishedAt: Optional[datetime] = None
+
+class JobCreate(BaseModel):
+    kind: JobKind
+    params: Dict[str, Any] = Field(default_factory=dict)
+
+class ExportJobParams(BaseModel):
+    format: DataFormat = DataFormat.NDJSON
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+class ArchiveJobParams(BaseModel):
+    days: Optional[int] = Field(default=None, ge=1)
+
 class DashboardStats(BaseModel):
     totalRevenue: Dict[str, float]
     totalUnits: Dict[str, int]
     distinctProducts: Dict[str, int]
     topSellers: List[Dict[str, Any]]
 
+class SalesBucket(BaseModel):
+    start: datetime
+    group: Optional[str] = None
+    revenue: float
+    units: int
+    salesCount: int
+
+class SalesAnalytics(BaseModel):
+    start: datetime
+    end: datetime
+    granularity: AnalyticsGranularity
+    groupBy: Optional[AnalyticsGroupBy] = None
+    buckets: List[SalesBucket]
+    totals: Dict[str, float]
+
 # Helper functions
-def prepare_for_mongo(data):
-    """Convert datetime objects to ISO strings for MongoDB storage"""
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, datetime):
-                data[key] = value.isoformat()
-    return data
-
-def parse_from_mongo(item):
-    """Parse datetime strings from MongoDB back to datetime objects"""
-    if isinstance(item, dict):
-        for key, value in item.items():
-            if key in ['createdAt', 'updatedAt', 'timestamp'] and isinstance(value, str):
-                try:
-                    item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except:
-                    pass
-    return item
+# Datetimes are stored as native BSON dates, so range queries, date indexes and
+# aggregation date operators work on them directly and reads need no parsing.
+# Databases written by older versions hold ISO strings in these fields until
+# migrate_datetimes has converted them.
+DATETIME_FIELDS = {"products": ["createdAt", "updatedAt"], "sales": ["timestamp"]}
+
+def as_utc(value: datetime) -> datetime:
+    """Normalize a datetime to UTC, treating naive values as already UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def to_datetime(value) -> datetime:
+    """Read a stored timestamp as a UTC datetime, accepting legacy ISO strings"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return as_utc(value)
+
+async def migrate_datetimes(batch_size: int = 1000):
+    """Convert legacy ISO-string timestamps to native dates in batches.
+
+    Only documents still holding strings are selected, so the migration can be
+    interrupted and rerun at any point. Strings that don't parse are logged
+    and left as they are.
+    """
+    converted = {}
+    for collection, fields in DATETIME_FIELDS.items():
+        converted[collection] = 0
+        legacy = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        last_id = None
+        while True:
+            query = {**legacy, "_id": {"$gt": last_id}} if last_id else legacy
+            docs = await db[collection].find(query, {field: 1 for field in fields}).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+
+            updates = []
+            for doc in docs:
+                update = {}
+                for field in fields:
+                    if isinstance(doc.get(field), str):
+                        try:
+                            update[field] = to_datetime(doc[field])
+                        except ValueError:
+                            logger.warning(f"Unparseable {collection}.{field} on {doc['_id']}: {doc[field]!r}")
+                if update:
+                    # Only replace the exact strings read, in case a writer got there first
+                    updates.append(UpdateOne({"_id": doc["_id"], **{field: doc[field] for field in update}}, {"$set": update}))
+            if updates:
+                result = await db[collection].bulk_write(updates, ordered=False)
+                converted[collection] += result.modified_count
+    return converted
+
+background_tasks = set()
+
+def run_in_background(coro):
+    """Run a coroutine as a fire-and-forget task, logging any failure"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+
+    def done(task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Background task failed", exc_info=task.exception())
+
+    task.add_done_callback(done)
+    return task
+
+# Search and indexes
+# Case-insensitive substring $regex can't use an index, so products and sales
+# carry a normalized searchTerms array (whole values plus their words, casefolded)
+# and searches become anchored prefix matches on that indexed field.
+def search_terms(*values: str) -> List[str]:
+    """Return the normalized terms a document can be found by"""
+    terms = set()
+    for value in values:
+        normalized = value.casefold().strip()
+        if normalized:
+            terms.add(normalized)
+            terms.update(re.findall(r"\w+", normalized))
+    return sorted(terms)
+
+def search_filter(search: str) -> Dict[str, Any]:
+    """Build an index-backed filter matching every word of `search` as a term prefix"""
+    words = search.casefold().split()
+    if not words:
+        return {}
+    return {"$and": [{"searchTerms": {"$regex": f"^{re.escape(word)}"}} for word in words]}
+
+def product_document(product: Product) -> Dict[str, Any]:
+    """Serialize a product for storage, including its search terms and change time"""
+    product_dict = product.model_dump()
+    product_dict["searchTerms"] = search_terms(product.name, product.code)
+    product_dict["changedAt"] = datetime.now(timezone.utc)
+    return product_dict
+
+def sale_document(sale: Sale) -> Dict[str, Any]:
+    """Serialize a sale for storage, including its search terms"""
+    sale_dict = sale.model_dump()
+    sale_dict["searchTerms"] = search_terms(sale.productName, sale.productCode)
+    return sale_dict
+
+# MongoDB error code for create_index with options differing from the existing index
+INDEX_OPTIONS_CONFLICT = 85
+
+async def ensure_ttl_index(collection: str, field: str, retention: timedelta):
+    """Create a TTL index on `field`, or move an existing one to `retention`"""
+    seconds = int(retention.total_seconds())
+    try:
+        await db[collection].create_index(field, expireAfterSeconds=seconds)
+    except OperationFailure as e:
+        # The retention setting changed since the index was built
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        await db.command("collMod", collection, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+        logger.info(f"Changed the {collection}.{field} TTL to {seconds}s")
+
+async def ensure_indexes():
+    """Create the indexes the API's queries rely on (no-op when they exist)"""
+    global product_codes_unique
+    try:
+        await db.products.create_index("code", unique=True)
+        product_codes_unique = True
+    except OperationFailure as e:
+        # Older databases can contain duplicate codes; keep serving with a
+        # plain index until they are cleaned up
+        logger.error(f"Could not enforce unique product codes, duplicates exist: {e}")
+        await db.products.create_index("code")
+    await db.products.create_index("searchTerms")
+    await db.products.create_index("changedAt")
+    await ensure_ttl_index("product_tombstones", "changedAt", PRODUCT_TOMBSTONE_RETENTION)
+    await db.sales.create_index([("timestamp", DESCENDING), ("id", DESCENDING)])
+    await db.sales.create_index([("productCode", ASCENDING), ("timestamp", DESCENDING)])
+    await db.sales.create_index([("searchTerms", ASCENDING), ("timestamp", DESCENDING)])
+    # Partial: only sales synced from a till queue carry a key
+    await db.sales.create_index(
+        "idempotencyKey",
+        unique=True,
+        partialFilterExpression={"idempotencyKey": {"$exists": True}}
+    )
+    await db.sales_rollups.create_index([("period", ASCENDING), ("revenue", DESCENDING)])
+    await db.sales_archive.create_index([("day", DESCENDING), ("productCode", ASCENDING)])
+    await db.sales_archive.create_index([("searchTerms", ASCENDING), ("day", DESCENDING)])
+    await db.sales_archive.create_index("sales.id")
+    await db.sales_archive.create_index(
+        "sales.idempotencyKey",
+        partialFilterExpression={"sales.idempotencyKey": {"$exists": True}}
+    )
+    await db.jobs.create_index([("createdAt", DESCENDING)])
+    await ensure_ttl_index("jobs", "finishedAt", JOB_RETENTION)
+    await db.job_files.create_index([("jobId", ASCENDING), ("n", ASCENDING)], unique=True)
+    await ensure_ttl_index("job_files", "createdAt", JOB_RETENTION)
+
+async def backfill_search_terms(batch_size: int = 500):
+    """Add searchTerms to products and sales stored before search indexing existed"""
+    sources = {"products": ("name", "code"), "sales": ("productName", "productCode")}
+    updated = {}
+    for collection, fields in sources.items():
+        updated[collection] = 0
+        while True:
+            docs = await db[collection].find(
+                {"searchTerms": {"$exists": False}},
+                {field: 1 for field in fields}
+            ).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                break
+            await db[collection].bulk_write([
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {"searchTerms": search_terms(*(doc.get(field, "") for field in fields))}}
+                )
+                for doc in docs
+            ], ordered=False)
+            updated[collection] += len(docs)
+    return updated
+
+def indexed_queries() -> List[Tuple[str, str, Dict[str, Any], Optional[List[Tuple[str, int]]], Optional[int]]]:
+    """The queries the routes issue, as (name, collection, filter, sort, limit).
+
+    Built with the routes' own query helpers, so the plans checked are the
+    plans the routes get.
+    """
+    position = {"timestamp": datetime(2026, 1, 1, tzinfo=timezone.utc), "id": "00000000-0000-0000-0000-000000000000"}
+    page = DEFAULT_PAGE_SIZE + 1
+    return [
+        ("product by code", "products", {"code": "SH-0001"}, None, None),
+        ("product list", "products", product_list_query(ProductCategory.SILK, None, "SH-0001"), PRODUCT_LIST_SORT, page),
+        ("product search", "products", product_list_query(None, "silk sh", None), PRODUCT_LIST_SORT, page),
+        ("recent sales", "sales", sales_list_query(None, None), SALES_LIST_SORT, page),
+        ("older sales", "sales", sales_list_query(None, position), SALES_LIST_SORT, page),
+        ("sales search", "sales", sales_list_query("silk", position), SALES_LIST_SORT, page),
+        ("sales export", "sales", date_range_filter("timestamp", position["timestamp"], None), [("timestamp", ASCENDING)], None),
+        ("top sellers", "sales_rollups", {"period": ROLLUP_ALL_TIME}, [("revenue", DESCENDING)], 10),
+        ("archived days", "sales_archive", archive_list_query(None, position), [("day", DESCENDING)], 1),
+        ("archive search", "sales_archive", archive_list_query("silk", position), [("day", DESCENDING)], 1),
+    ]
+
+# A plan without a collection scan can still read every document, e.g. by
+# walking the whole code index for the sort and filtering on searchTerms, so a
+# query also fails the check when it examines this many documents per result
+EXPLAIN_MAX_DOCS_PER_RESULT = 10
+
+async def explain_indexed_queries():
+    """Explain every query in indexed_queries() and report whether an index keeps it selective"""
+    report = []
+    for name, collection, query, sort, limit in indexed_queries():
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = dict(sort)
+        if limit:
+            command["limit"] = limit
+        explanation = await db.command({"explain": command, "verbosity": "executionStats"})
+        summary = slow_queries.explain_summary(explanation)
+        docs_examined = summary["docsExamined"] or 0
+        returned = summary["nReturned"] or 0
+        selective = docs_examined <= EXPLAIN_MAX_DOCS_PER_RESULT * max(returned, 1)
+        report.append({
+            "query": name,
+            "collection": collection,
+            "stages": summary["stages"],
+            "collectionScan": summary["collectionScan"],
+            "docsExamined": docs_examined,
+            "nReturned": returned,
+            "indexBacked": not summary["collectionScan"] and selective,
+        })
+    return report
+
+# Fast list serialization
+# List routes project exactly the model's fields (no _id, no searchTerms) and
+# hand the stored documents straight to orjson. They were validated on the way
+# in, so they skip both model construction and FastAPI's response_model
+# validation and encoding; response_model stays on the routes for the docs.
+PRODUCT_PROJECTION = {"_id": 0, **{field: 1 for field in Product.model_fields}}
+SALE_PROJECTION = {"_id": 0, **{field: 1 for field in Sale.model_fields}}
+
+# Keyset pagination
+# List routes return one page plus an opaque X-Next-Cursor header holding the
+# sort key of the last row; the next page seeks past it on an index, so deep
+# pages cost the same as the first one.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    """Encode a sort-key position as an opaque URL-safe token"""
+    token = json.dumps(position, separators=(",", ":"), default=lambda value: value.isoformat())
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, keys: List[str]) -> Dict[str, Any]:
+    """Decode a token from encode_cursor, rejecting anything that isn't one"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        position = None
+    # Every position encode_cursor writes (codes, ids, ISO datetimes) is a string
+    if (not isinstance(position, dict) or sorted(position) != sorted(keys)
+            or not all(isinstance(value, str) for value in position.values())):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return position
+
+def paginate(docs: List[Dict[str, Any]], page_size: int, keys: List[str]) -> FastJSONResponse:
+    """Respond with a page fetched with one extra row, advertising the next cursor if there is more"""
+    headers = {}
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor({key: docs[-1][key] for key in keys})
+    return FastJSONResponse(docs, headers=headers)
+
+# Product sync
+# Every product write stamps changedAt (stock changes from sales included) and
+# deletes leave a tombstone, so a client holding a catalogue can ask for just
+# what changed since its last sync. The token is the time the previous sync
+# started; changes are re-read from PRODUCT_SYNC_OVERLAP before it, so writes
+# that were still in flight then (or stamped by a worker with a slightly
+# different clock) are not missed. Tombstones expire after
+# PRODUCT_TOMBSTONE_RETENTION; older tokens get the full catalogue again.
+PRODUCT_SYNC_OVERLAP = timedelta(seconds=float(os.environ.get("PRODUCT_SYNC_OVERLAP", "10")))
+PRODUCT_TOMBSTONE_RETENTION = timedelta(days=float(os.environ.get("PRODUCT_TOMBSTONE_DAYS", "30")))
+
+async def clear_tombstones(codes: List[str]):
+    """Forget deletions of codes that are being (re)created"""
+    if codes:
+        await db.product_tombstones.delete_many({"_id": {"$in": codes}})
+
+# Sales rollups
+# Every sale is folded into small counter documents as it is recorded, so the
+# dashboard reads a handful of rollups instead of scanning db.sales:
+#   sales_rollups: one document per (period, product) with units and revenue
+#   sales_totals:  one document per period with units, revenue and distinct products
+ROLLUP_ALL_TIME = "all"
+
+def rollup_periods(timestamp: datetime) -> List[str]:
+    """Return the rollup period keys (day, month, all time) a timestamp falls into"""
+    ts = timestamp.astimezone(timezone.utc)
+    return [f"day:{ts:%Y-%m-%d}", f"month:{ts:%Y-%m}", ROLLUP_ALL_TIME]
+
+def accumulate_rollups(sales, product_stats: Dict, period_stats: Dict):
+    """Add sales to in-memory (period, product) and period counters"""
+    for sale in sales:
+        revenue = sale["priceAtSale"] * sale["quantity"]
+        for period in rollup_periods(sale["timestamp"]):
+            stats = product_stats.setdefault(
+                (period, sale["productCode"]),
+                {"productName": sale["productName"], "units": 0, "revenue": 0}
+            )
+            stats["units"] += sale["quantity"]
+            stats["revenue"] += revenue
+            totals = period_stats.setdefault(period, {"units": 0, "revenue": 0})
+            totals["units"] += sale["quantity"]
+            totals["revenue"] += revenue
+
+# While a rebuild runs, record_sale_rollups journals sales instead of
+# counting them, and the rebuild counts the journaled sales its scan missed
+# once the rebuilt rollups are live. Writers check for a rebuild at most every
+# ROLLUP_REBUILD_CHECK_INTERVAL seconds, so the rebuild waits
+# ROLLUP_REBUILD_GRACE seconds for writers to notice its start (before
+# scanning) and its end (before the last journal sweep).
+ROLLUP_REBUILD_LEASE = "rebuild_rollups"
+ROLLUP_REBUILD_CHECK_INTERVAL = 1.0
+ROLLUP_REBUILD_GRACE = 5.0
+ROLLUP_SALE_FIELDS = ("id", "productCode", "productName", "priceAtSale", "quantity", "timestamp")
+rollup_rebuild_checked = (float("-inf"), False)
+
+async def rollup_rebuild_running() -> bool:
+    global rollup_rebuild_checked
+    checked_at, running = rollup_rebuild_checked
+    if time.monotonic() - checked_at < ROLLUP_REBUILD_CHECK_INTERVAL:
+        return running
+    checked_at = time.monotonic()
+    running = await db.leases.find_one(
+        {"_id": ROLLUP_REBUILD_LEASE, "expiresAt": {"$gt": datetime.now(timezone.utc)}}, {"_id": 1}
+    ) is not None
+    rollup_rebuild_checked = (checked_at, running)
+    return running
+
+async def increment_rollups(sales: List[Dict[str, Any]]):
+    """Add sales to the live rollup counters"""
+    product_stats, period_stats = {}, {}
+    accumulate_rollups(sales, product_stats, period_stats)
+    keys = list(product_stats)
+    result = await db.sales_rollups.bulk_write([
+        UpdateOne(
+            {"_id": f"{period}|{code}"},
+            {
+                "$inc": {"units": product_stats[(period, code)]["units"], "revenue": product_stats[(period, code)]["revenue"]},
+                "$set": {"productName": product_stats[(period, code)]["productName"]},
+                "$setOnInsert": {"period": period, "productCode": code},
+            },
+            upsert=True
+        )
+        for period, code in keys
+    ], ordered=False)
+
+    # A product's first sale in a period creates its rollup document, which is
+    # exactly when the period's distinct product count goes up
+    for index in result.upserted_ids:
+        period = keys[index][0]
+        period_stats[period]["distinctProducts"] = period_stats[period].get("distinctProducts", 0) + 1
+
+    await db.sales_totals.bulk_write([
+        UpdateOne({"_id": period}, {"$inc": stats}, upsert=True)
+        for period, stats in period_stats.items()
+    ], ordered=False)
+
+async def record_sale_rollups(sales: List[Sale]):
+    """Increment the rollup counters for newly recorded sales.
+
+    The sales are already stored when this runs, so a failure here doesn't
+    fail them (a till would retry and record them twice): it is logged and
+    counted in /api/metrics, and the next rollup rebuild counts the sales.
+    """
+    if not sales:
+        return
+    docs = [sale.model_dump() for sale in sales]
+    try:
+        if await rollup_rebuild_running():
+            await db.sales_rollup_journal.insert_one({
+                "sales": [{field: doc[field] for field in ROLLUP_SALE_FIELDS} for doc in docs],
+                "at": datetime.now(timezone.utc),
+            })
+        else:
+            await increment_rollups(docs)
+    except Exception as e:
+        metrics.sale_rollup_failures.inc(amount=len(sales))
+        logger.error(f"Could not count sales {[sale.id for sale in sales]} into the rollups, "
+                     f"rebuild them to correct the dashboard: {e}")
+    dashboard_cache.invalidate()
+
+async def apply_rollup_journal(counted: set) -> int:
+    """Count the journaled sales a rebuild didn't see into the live rollups"""
+    applied = 0
+    while True:
+        entries = await db.sales_rollup_journal.find({}).limit(100).to_list(length=100)
+        if not entries:
+            return applied
+        sales = [sale for entry in entries for sale in entry["sales"] if sale["id"] not in counted]
+        if sales:
+            await increment_rollups(sales)
+        await db.sales_rollup_journal.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}})
+        applied += len(sales)
+
+async def rebuild_sales_rollups(batch_size: int = 1000, progress=None):
+    """Recompute all rollups from db.sales and the archive and swap them in.
+
+    Safe while sales are being recorded: those are journaled and counted
+    after the swap. Archiving waits for the rebuild (and vice versa), so no
+    sale moves between the tiers while they are read.
+    """
+    async with lease(ROLLUP_REBUILD_LEASE, "A rollup rebuild is already running") as renew_rebuild, \
+            lease("archive_sales", "Sales archiving is running, retry the rebuild later") as renew_archive:
+        started = datetime.now(timezone.utc)
+        # Left over from a rebuild that crashed; the scan counts those sales
+        await db.sales_rollup_journal.delete_many({"at": {"$lt": started}})
+        # Writers that haven't noticed the rebuild yet must be done counting
+        # into the live rollups before the scan starts, or their sales could
+        # land after it and be lost with the rollups it replaces
+        await asyncio.sleep(ROLLUP_REBUILD_GRACE)
+        await renew_rebuild()
+        await renew_archive()
+        # Sales inserted around the start may be journaled too; remember which
+        # of them the scan counted
+        recent_since = ObjectId.from_datetime(started - timedelta(minutes=1))
+        recent = set()
+
+        product_stats, period_stats = {}, {}
+        sales_count = 0
+        cursor = db.sales.find({}, {"_id": 1, "id": 1, "productCode": 1, "productName": 1, "priceAtSale": 1, "quantity": 1, "timestamp": 1})
+        archived = db.sales_archive.aggregate(ARCHIVED_SALE_STAGES, allowDiskUse=True, batchSize=batch_size)
+        batch = []
+        async for sale in chain_async(archived, cursor.batch_size(batch_size)):
+            if sale.get("_id", recent_since) > recent_since:
+                recent.add(sale["id"])
+            batch.append({**sale, "timestamp": to_datetime(sale["timestamp"])})
+            if len(batch) >= batch_size:
+                accumulate_rollups(batch, product_stats, period_stats)
+                sales_count += len(batch)
+                batch = []
+                await renew_rebuild()
+                await renew_archive()
+                if progress:
+                    await progress(sales_count)
+        accumulate_rollups(batch, product_stats, period_stats)
+        sales_count += len(batch)
+
+        for period, _code in product_stats:
+            totals = period_stats[period]
+            totals["distinctProducts"] = totals.get("distinctProducts", 0) + 1
+
+        # Build into scratch collections and rename over the live ones so the
+        # dashboard never sees a half-built rollup
+        await db.sales_rollups_rebuild.drop()
+        await db.sales_totals_rebuild.drop()
+        rollup_docs = [
+            {"_id": f"{period}|{code}", "period": period, "productCode": code, **stats}
+            for (period, code), stats in product_stats.items()
+        ]
+        for start in range(0, len(rollup_docs), batch_size):
+            await db.sales_rollups_rebuild.insert_many(rollup_docs[start:start + batch_size], ordered=False)
+        if period_stats:
+            await db.sales_totals_rebuild.insert_many(
+                [{"_id": period, **stats} for period, stats in period_stats.items()], ordered=False
+            )
+
+        for scratch, live in (("sales_rollups_rebuild", "sales_rollups"), ("sales_totals_rebuild", "sales_totals")):
+            if rollup_docs:
+                await db[scratch].rename(live, dropTarget=True)
+            else:
+                await db[live].drop()
+        journaled = await apply_rollup_journal(recent)
+
+    # Writers that noticed the end late may still have journaled
+    await asyncio.sleep(ROLLUP_REBUILD_GRACE)
+    journaled += await apply_rollup_journal(recent)
+    dashboard_cache.invalidate()
+    return {"sales": sales_count + journaled, "rollups": len(rollup_docs), "periods": len(period_stats)}
+
+# Sales archive
+# db.sales only holds recent sales. Sales older than SALES_ARCHIVE_AFTER are
+# periodically folded into sales_archive: one bucket document per product and
+# day (and the name and color it was sold under) holding up to
+# SALES_ARCHIVE_BUCKET_SIZE compact {id, t, q, p} entries in time order, so
+# the name and color are stored once per bucket instead of once per sale.
+# Sales synced from a till queue keep their idempotencyKey in their entry, so
+# a retried sync still finds them once they are archived.
+# Buckets record the first and last time they cover, so reading a page of
+# archived sales only expands the buckets of the days it spans, however deep
+# in the history it is. Listing, export, analytics and rollup rebuilds read
+# both tiers; the dashboard reads rollups, which archiving leaves untouched.
+SALES_ARCHIVE_AFTER = timedelta(days=int(os.environ.get("SALES_ARCHIVE_AFTER_DAYS", "180")))
+SALES_ARCHIVE_INTERVAL = float(os.environ.get("SALES_ARCHIVE_INTERVAL", "3600"))
+SALES_ARCHIVE_BUCKET_SIZE = 2000
+
+# Expands buckets back into documents shaped like db.sales
+ARCHIVED_SALE_FIELDS = {
+    "_id": 0,
+    "id": "$sales.id",
+    "productCode": 1,
+    "productName": 1,
+    "priceAtSale": "$sales.p",
+    "colorAtSale": 1,
+    "timestamp": "$sales.t",
+    "quantity": "$sales.q",
+}
+ARCHIVED_SALE_STAGES = [{"$unwind": "$sales"}, {"$project": ARCHIVED_SALE_FIELDS}]
+
+def archive_day(timestamp: datetime) -> str:
+    return f"{timestamp.astimezone(timezone.utc):%Y-%m-%d}"
+
+def archive_range_filter(start: Optional[datetime], end: Optional[datetime]) -> Dict[str, Any]:
+    """Filter on the buckets that can hold sales within [start, end)"""
+    query = {}
+    days = {}
+    if start:
+        days["$gte"] = archive_day(as_utc(start))
+        query["to"] = {"$gte": as_utc(start)}
+    if end:
+        days["$lte"] = archive_day(as_utc(end))
+        query["from"] = {"$lt": as_utc(end)}
+    if days:
+        query["day"] = days
+    return query
+
+# Leases
+# A lease is a document in db.leases naming its holder and when it expires,
+# so a job that must not run twice at once (across workers and maintenance
+# commands) can tell when another run holds it, and a crashed holder only
+# blocks others until the lease expires.
+LEASE_DURATION = timedelta(minutes=5)
+
+async def acquire_lease(name: str, holder: str, duration: timedelta = LEASE_DURATION) -> bool:
+    """Take or extend the named lease for `holder` unless someone else holds it"""
+    now = datetime.now(timezone.utc)
+    try:
+        # A lease held by someone else doesn't match, so the upsert collides on _id
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"expiresAt": {"$lte": now}}, {"holder": holder}]},
+            {"$set": {"holder": holder, "expiresAt": now + duration}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+@asynccontextmanager
+async def lease(name: str, busy_detail: str):
+    """Hold the named lease for the duration of the block, or raise 409.
+
+    Yields a coroutine function that extends the lease; call it between steps
+    of long runs. It raises 409 if the lease expired and was taken over.
+    """
+    holder = uuid.uuid4().hex
+    if not await acquire_lease(name, holder):
+        raise HTTPException(status_code=409, detail=busy_detail)
+
+    async def renew():
+        if not await acquire_lease(name, holder):
+            raise HTTPException(status_code=409, detail=busy_detail)
+
+    try:
+        yield renew
+    finally:
+        await db.leases.update_one({"_id": name, "holder": holder}, {"$set": {"expiresAt": datetime.now(timezone.utc)}})
+
+async def archive_sales(before: datetime, batch_size: int = 1000, progress=None) -> int:
+    """Move the sales recorded before `before` into the archive.
+
+    Runs hold the archive lease, so only one moves sales at a time; an
+    interrupted run is safe to repeat.
+    """
+    async with lease("archive_sales", "Sales archiving is already running") as renew:
+        archived = 0
+        while True:
+            await renew()
+            sales = await db.sales.find(
+                {"timestamp": {"$lt": before}}, {**SALE_PROJECTION, "_id": 1, "idempotencyKey": 1}
+            ).sort([("timestamp", ASCENDING), ("id", ASCENDING)]).limit(batch_size).to_list(length=batch_size)
+            if not sales:
+                return archived
+            # A run interrupted between writing buckets and deleting the
+            # originals leaves sales in both tiers; don't archive those twice
+            done = set(await db.sales_archive.distinct("sales.id", {"sales.id": {"$in": [sale["id"] for sale in sales]}}))
+
+            buckets = {}
+            for sale in sales:
+                if sale["id"] not in done:
+                    key = (archive_day(sale["timestamp"]), sale["productCode"], sale["productName"], sale["colorAtSale"])
+                    buckets.setdefault(key, []).append(sale)
+            writes = []
+            for (day, code, name, color), entries in buckets.items():
+                for start in range(0, len(entries), SALES_ARCHIVE_BUCKET_SIZE):
+                    chunk = entries[start:start + SALES_ARCHIVE_BUCKET_SIZE]
+                    writes.append(UpdateOne(
+                        # Fill the bucket that has room, or start a new one
+                        {"day": day, "productCode": code, "productName": name, "colorAtSale": color,
+                         "count": {"$lte": SALES_ARCHIVE_BUCKET_SIZE - len(chunk)}},
+                        {
+                            "$push": {"sales": {"$each": [
+                                {"id": sale["id"], "t": sale["timestamp"], "q": sale["quantity"], "p": sale["priceAtSale"],
+                                 **({"idempotencyKey": sale["idempotencyKey"]} if "idempotencyKey" in sale else {})}
+                                for sale in chunk
+                            ], "$sort": {"t": 1}}},
+                            "$inc": {
+                                "count": len(chunk),
+                                "units": sum(sale["quantity"] for sale in chunk),
+                                "revenue": sum(sale["priceAtSale"] * sale["quantity"] for sale in chunk),
+                            },
+                            "$min": {"from": chunk[0]["timestamp"]},
+                            "$max": {"to": chunk[-1]["timestamp"]},
+                            "$setOnInsert": {"searchTerms": search_terms(name, code)},
+                        },
+                        upsert=True
+                    ))
+            if writes:
+                await db.sales_archive.bulk_write(writes)
+            # By _id: the sales indexes only have id behind timestamp
+            await db.sales.delete_many({"_id": {"$in": [sale["_id"] for sale in sales]}})
+            archived += len(sales)
+            if progress:
+                await progress(archived)
+
+async def archived_sales(bucket_query: Dict[str, Any], sale_query: Dict[str, Any],
+                         descending: bool = False, limit: Optional[int] = None):
+    """Yield archived sales in time order, expanding one day of buckets at a time"""
+    direction = DESCENDING if descending else ASCENDING
+    remaining = limit
+    day = None
+    while True:
+        query = bucket_query
+        if day:
+            query = {"$and": [bucket_query, {"day": {"$lt" if descending else "$gt": day}}]}
+        bucket = await db.sales_archive.find_one(query, {"_id": 0, "day": 1}, sort=[("day", direction)])
+        if not bucket:
+            return
+        day = bucket["day"]
+        pipeline = [{"$match": {"$and": [bucket_query, {"day": day}]}}, *ARCHIVED_SALE_STAGES]
+        if sale_query:
+            pipeline.append({"$match": sale_query})
+        pipeline.append({"$sort": {"timestamp": direction, "id": direction}})
+        if remaining:
+            pipeline.append({"$limit": remaining})
+        async for sale in db.sales_archive.aggregate(pipeline, allowDiskUse=True):
+            yield sale
+            if remaining:
+                remaining -= 1
+                if not remaining:
+                    return
+
+async def chain_async(*sources):
+    """Yield from each async iterable in turn"""
+    for source in sources:
+        async for item in source:
+            yield item
+
+async def archive_sales_periodically():
+    """Archive old sales every SALES_ARCHIVE_INTERVAL seconds, on one worker per interval"""
+    while True:
+        await asyncio.sleep(SALES_ARCHIVE_INTERVAL)
+        try:
+            if await acquire_lease("archive_sales_schedule", uuid.uuid4().hex, timedelta(seconds=SALES_ARCHIVE_INTERVAL)):
+                archived = await archive_sales(datetime.now(timezone.utc) - SALES_ARCHIVE_AFTER)
+                if archived:
+                    logger.info(f"Archived {archived} sales")
+        except HTTPException as e:
+            logger.info(f"Skipped sales archiving: {e.detail}")
+        except Exception as e:
+            logger.warning(f"Sales archiving failed, retrying: {e}")
+
+# Product cache
+# Scans look the same popular shawls up over and over, so get_product serves
+# them from a bounded in-process LRU. Writes made through this worker update
+# or drop the entry straight away; the TTL bounds how long a change made by
+# another worker can go unseen.
+PRODUCT_CACHE_SIZE = int(os.environ.get("PRODUCT_CACHE_SIZE", "1024"))
+PRODUCT_CACHE_TTL = float(os.environ.get("PRODUCT_CACHE_TTL", "5"))
+
+class ProductCache:
+    """Bounded LRU cache of Product models with a per-entry TTL"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, code: str) -> Optional[Product]:
+        entry = self.entries.get(code)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(code)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            del self.entries[code]
+        self.misses += 1
+        return None
+
+    def put(self, product: Product):
+        if self.max_size <= 0:
+            return
+        self.entries[product.code] = (time.monotonic() + self.ttl, product)
+        self.entries.move_to_end(product.code)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def set_stock(self, code: str, stock_qty: int):
+        """Apply a sale's stock decrement to a cached product without refetching it"""
+        entry = self.entries.get(code)
+        # Concurrent sales can report back out of order; sales only ever lower
+        # stock, so the smallest value seen is the most recent one
+        if entry and stock_qty < entry[1].stockQty:
+            self.entries[code] = (entry[0], entry[1].model_copy(update={"stockQty": stock_qty}))
+
+    def invalidate(self, code: str):
+        if self.entries.pop(code, None):
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxSize": self.max_size,
+            "ttlSeconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+product_cache = ProductCache(PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL)
+
+# Color index
+# Nearest-color search keeps every product's color as a CIELAB point in
+# NumPy arrays, so a query is one vectorized distance computation rather than a
+# catalogue scan. The index loads lazily, is kept current by this worker's
+# product and stock writes, and is reloaded after COLOR_INDEX_MAX_AGE seconds
+# to pick up writes made by other workers.
+COLOR_INDEX_MAX_AGE = float(os.environ.get("COLOR_INDEX_MAX_AGE", "300"))
+
+class ColorIndex:
+    """In-memory CIELAB positions and stock flags of every product"""
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+        # The arrays are built on the first load, so NumPy isn't imported
+        # before a color route needs it
+        self.codes = []
+        self.rows = {}
+        self.lab = None
+        self.in_stock = None
+
+    async def ensure_loaded(self):
+        import numpy as np
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.max_age:
+            return
+        async with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.max_age:
+                return
+            products = await db.products.find(
+                {}, {"_id": 0, "code": 1, "colorHex": 1, "stockQty": 1}
+            ).to_list(length=None)
+            self.codes = [product["code"] for product in products]
+            self.rows = {code: row for row, code in enumerate(self.codes)}
+            self.lab = colors.hex_to_lab_array([product["colorHex"] for product in products])
+            self.in_stock = np.array([product["stockQty"] > 0 for product in products], dtype=bool)
+            self.loaded_at = time.monotonic()
+
+    def upsert(self, code: str, color_hex: str, stock_qty: int):
+        if self.loaded_at is None:
+            return
+        import numpy as np
+        lab = colors.hex_to_lab_array([color_hex])
+        row = self.rows.get(code)
+        if row is None:
+            self.rows[code] = len(self.codes)
+            self.codes.append(code)
+            self.lab = np.vstack([self.lab, lab])
+            self.in_stock = np.append(self.in_stock, stock_qty > 0)
+        else:
+            self.lab[row] = lab[0]
+            self.in_stock[row] = stock_qty > 0
+
+    def set_stock(self, code: str, stock_qty: int):
+        row = self.rows.get(code)
+        if row is not None:
+            self.in_stock[row] = stock_qty > 0
+
+    def remove(self, code: str):
+        row = self.rows.pop(code, None)
+        if row is None:
+            return
+        # Move the last product into the freed row so the arrays stay dense
+        last = len(self.codes) - 1
+        if row != last:
+            self.codes[row] = self.codes[last]
+            self.rows[self.codes[row]] = row
+            self.lab[row] = self.lab[last]
+            self.in_stock[row] = self.in_stock[last]
+        self.codes.pop()
+        self.lab = self.lab[:last]
+        self.in_stock = self.in_stock[:last]
+
+    def nearest(self, color_hex: str, k: int, in_stock_only: bool = True):
+        """Return up to k (code, delta E) pairs closest to a color"""
+        import numpy as np
+        candidates = np.flatnonzero(self.in_stock) if in_stock_only else np.arange(len(self.codes))
+        if not len(candidates):
+            return []
+        target = colors.hex_to_lab_array([color_hex])[0]
+        distances = np.sqrt(((self.lab[candidates] - target) ** 2).sum(axis=1))
+        if len(candidates) > k:
+            nearest = np.argpartition(distances, k)[:k]
+        else:
+            nearest = np.arange(len(candidates))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return [(self.codes[candidates[i]], float(distances[i])) for i in nearest]
+
+color_index = ColorIndex(COLOR_INDEX_MAX_AGE)
+
+# Product codes
+# Codes are allocated from an atomic counter document instead of counting
+# products, so allocation is O(1) and concurrent creates (or deletes) can never
+# produce the same code twice. Each worker reserves PRODUCT_CODE_BLOCK_SIZE
+# numbers per round trip; numbers left in a block when a worker stops are
+# skipped, so larger blocks trade gaps in the sequence for fewer writes.
+PRODUCT_CODE_PREFIX = "SH-"
+PRODUCT_CODE_PATTERN = re.compile(rf"^{PRODUCT_CODE_PREFIX}(\d+)$")
+PRODUCT_CODE_SEQUENCE = "product_code"
+PRODUCT_CODE_BLOCK_SIZE = int(os.environ.get("PRODUCT_CODE_BLOCK_SIZE", "1"))
+# Generated codes can still collide with an explicit SH- code created inside a
+# block another worker holds; creation then retries with the next code
+PRODUCT_CODE_ATTEMPTS = 5
+# Set once ensure_indexes has built the unique index on code. Until then (lazy
+# startup) or when legacy duplicates prevent it, creates look the code up first
+product_codes_unique = False
+
+async def next_sequence(name: str, n: int = 1) -> int:
+    """Atomically reserve `n` consecutive values of a named sequence, returning the first"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": n}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"] - n + 1
+
+class SequenceBlock:
+    """Hands out values of a sequence from blocks reserved in a single round trip.
+
+    `prepare`, if given, runs once before the first value is handed out.
+    """
+
+    def __init__(self, name: str, block_size: int, prepare=None):
+        self.name = name
+        self.block_size = max(1, block_size)
+        self.next_value = 0
+        self.end = 0
+        self.prepare = prepare
+        self.lock = asyncio.Lock()
+
+    async def run_prepare(self):
+        if self.prepare:
+            await self.prepare()
+            self.prepare = None
+
+    async def ensure_prepared(self):
+        async with self.lock:
+            await self.run_prepare()
+
+    async def take(self, n: int) -> List[int]:
+        values = []
+        async with self.lock:
+            await self.run_prepare()
+            while len(values) < n:
+                if self.next_value >= self.end:
+                    size = max(self.block_size, n - len(values))
+                    self.next_value = await next_sequence(self.name, size)
+                    self.end = self.next_value + size
+                count = min(n - len(values), self.end - self.next_value)
+                values.extend(range(self.next_value, self.next_value + count))
+                self.next_value += count
+        return values
 
 async def generate_product_code():
     """Generate unique product code"""
-    count = await db.products.count_documents({})
-    return f"SH-{count + 1:04d}"
+    return (await generate_product_codes(1))[0]
 
-# Product Routes
-@api_router.post("/products", response_model=Product)
-async def create_product(product: ProductCreate):
-    if not product.code:
-        product.code = await generate_product_code()
-    
-    # Check if code already exists
-    existing = await db.products.find_one({"code": product.code})
-    if existing:
-        raise HTTPException(status_code=400, detail="Product code already exists")
-    
-    product_dict = product.dict()
-    product_obj = Product(**product_dict)
-    product_dict = prepare_for_mongo(product_obj.dict())
-    
-    result = await db.products.insert_one(product_dict)
-    if result.inserted_id:
-        return product_obj
-    raise HTTPException(status_code=400, detail="Failed to create product")
+async def generate_product_codes(n: int) -> List[str]:
+    """Allocate `n` unique product codes"""
+    return [f"{PRODUCT_CODE_PREFIX}{value:04d}" for value in await product_code_block.take(n)]
 
-@api_router.get("/products", response_model=List[Product])
-async def get_products(category: Optional[ProductCategory] = None, search: Optional[str] = None):
+async def reserve_product_codes(codes: List[str]):
+    """Move the code sequence past any explicitly chosen SH- codes so it never hands them out"""
+    numbers = [int(match.group(1)) for match in map(PRODUCT_CODE_PATTERN.match, codes) if match]
+    if numbers:
+        await db.counters.update_one(
+            {"_id": PRODUCT_CODE_SEQUENCE},
+            {"$max": {"seq": max(numbers)}},
+            upsert=True
+        )
+
+async def seed_product_code_sequence():
+    """Start the code sequence after the highest SH- code already in the catalogue"""
+    cursor = db.products.find({"code": {"$regex": f"^{PRODUCT_CODE_PREFIX}"}}, {"_id": 0, "code": 1})
+    await reserve_product_codes([product["code"] async for product in cursor])
+
+# Seeded at startup in eager mode, before the first code otherwise
+product_code_block = SequenceBlock(PRODUCT_CODE_SEQUENCE, PRODUCT_CODE_BLOCK_SIZE, prepare=seed_product_code_sequence)
+
+# Product import
+# Uploads are read from the spooled temp file a chunk of rows at a time, so an
+# import of any size holds at most IMPORT_CHUNK_SIZE rows in memory
+IMPORT_CHUNK_SIZE = 500
+
+def upload_format(file: UploadFile, format: Optional[DataFormat]) -> DataFormat:
+    """The format asked for, or else the one the upload's name or content type suggests"""
+    if format is not None:
+        return format
+    filename = (file.filename or "").lower()
+    return DataFormat.CSV if filename.endswith(".csv") or file.content_type == "text/csv" else DataFormat.NDJSON
+
+def upload_rows(source, import_format: DataFormat):
+    """Yield (row number, raw row or parse error) from an uploaded CSV or NDJSON binary file"""
+    text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    if import_format == DataFormat.CSV:
+        reader = csv.DictReader(text)
+        for row in reader:
+            # Blank cells mean "use the default", e.g. an auto-generated code
+            yield reader.line_num, {k: v for k, v in row.items() if k and v not in (None, "")}
+        return
+    for line_num, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError as e:
+            yield line_num, e
+
+def validation_message(error: ValidationError) -> str:
+    """Flatten a pydantic ValidationError into one readable line"""
+    return "; ".join(f"{'.'.join(str(loc) for loc in e['loc'])}: {e['msg']}" for e in error.errors())
+
+async def insert_product_rows(rows, report: ImportReport):
+    """Insert (row number, product, generated code) rows in one unordered batch.
+
+    Returns the products inserted and the rows with a generated code that
+    turned out to be taken, to retry with new codes; other failures go into
+    the report.
+    """
+    retry = []
+
+    def code_taken(row):
+        row_num, product, generated = row
+        if generated:
+            retry.append(row)
+        else:
+            report.errors.append(ImportRowError(row=row_num, code=product.code, error="Product code already exists"))
+
+    if not product_codes_unique:
+        # Without the unique index nothing else stops a duplicate code
+        taken = {doc["code"] async for doc in db.products.find(
+            {"code": {"$in": [product.code for _, product, _ in rows]}}, {"_id": 0, "code": 1})}
+        fresh = []
+        for row in rows:
+            if row[1].code in taken:
+                code_taken(row)
+            else:
+                # A later row of the chunk with the same code is a duplicate too
+                taken.add(row[1].code)
+                fresh.append(row)
+        rows = fresh
+    if not rows:
+        return [], retry
+
+    failed = set()
+    try:
+        await db.products.insert_many([product_document(Product(**product.model_dump())) for _, product, _ in rows], ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details["writeErrors"]:
+            failed.add(write_error["index"])
+            row = rows[write_error["index"]]
+            if write_error["code"] == 11000:
+                code_taken(row)
+            else:
+                report.errors.append(ImportRowError(row=row[0], code=row[1].code, error=write_error["errmsg"]))
+    inserted = [product for index, (_, product, _) in enumerate(rows) if index not in failed]
+    report.inserted += len(inserted)
+    return inserted, retry
+
+async def import_product_chunk(rows, report: ImportReport):
+    """Validate a chunk of raw rows and insert the valid ones in one unordered batch.
+
+    Rows whose generated code collides with an existing one are retried with
+    new codes, up to PRODUCT_CODE_ATTEMPTS times, as create_product does.
+    """
+    valid = []
+    for row_num, raw in rows:
+        if isinstance(raw, Exception):
+            report.errors.append(ImportRowError(row=row_num, error=f"Invalid JSON: {raw}"))
+            continue
+        if not isinstance(raw, dict):
+            report.errors.append(ImportRowError(row=row_num, error="Row must be an object"))
+            continue
+        try:
+            valid.append((row_num, ProductCreate(**raw)))
+        except ValidationError as e:
+            # The code may itself be what failed validation, e.g. a number
+            code = raw.get("code") if isinstance(raw.get("code"), str) else None
+            report.errors.append(ImportRowError(row=row_num, code=code, error=validation_message(e)))
+
+    await reserve_product_codes([product.code for _, product in valid if product.code])
+    pending = [(row_num, product, not product.code) for row_num, product in valid]
+    inserted = []
+    for _attempt in range(PRODUCT_CODE_ATTEMPTS):
+        if not pending:
+            break
+        codes = iter(await generate_product_codes(sum(1 for _, _, generated in pending if generated)))
+        for _, product, generated in pending:
+            if generated:
+                product.code = next(codes)
+        inserted_now, pending = await insert_product_rows(pending, report)
+        inserted += inserted_now
+    for row_num, _, _ in pending:
+        report.errors.append(ImportRowError(row=row_num, error="Could not allocate a free product code"))
+
+    await clear_tombstones([product.code for product in inserted])
+    for product in inserted:
+        color_index.upsert(product.code, product.colorHex, product.stockQty)
+
+async def import_product_file(source, import_format: DataFormat, progress=None) -> ImportReport:
+    """Import every row of an uploaded file, a chunk at a time"""
+    report = ImportReport(received=0, inserted=0, failed=0, errors=[])
+    rows = upload_rows(source, import_format)
+    try:
+        while True:
+            chunk = await run_in_threadpool(lambda: list(islice(rows, IMPORT_CHUNK_SIZE)))
+            if not chunk:
+                break
+            report.received += len(chunk)
+            await import_product_chunk(chunk, report)
+            if progress:
+                await progress(report.received)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not read upload: {e}")
+
+    report.errors.sort(key=lambda error: error.row)
+    report.failed = len(report.errors)
+    return report
+
+PRODUCT_LIST_SORT = [("code", ASCENDING)]
+
+def product_list_query(category: Optional[ProductCategory], search: Optional[str], after: Optional[str]) -> Dict[str, Any]:
+    """The filter GET /api/products pages through, in PRODUCT_LIST_SORT order"""
     query = {}
     if category:
         query["category"] = category.value
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"code": {"$regex": search, "$options": "i"}}
-        ]
-    
-    products = await db.products.find(query).to_list(length=None)
-    return [Product(**parse_from_mongo(product)) for product in products]
+        query.update(search_filter(search))
+    if after:
+        query["code"] = {"$gt": after}
+    return query
+
+async def insert_new_product(product_obj: Product) -> bool:
+    """Insert a product, returning False if its code is already taken"""
+    if not product_codes_unique and await db.products.find_one({"code": product_obj.code}, {"_id": 1}):
+        return False
+    try:
+        await db.products.insert_one(product_document(product_obj))
+    except DuplicateKeyError:
+        return False
+    return True
+
+# Product Routes
+@api_router.post("/products", response_model=Product)
+async def create_product(product: ProductCreate):
+    generated = not product.code
+    if not generated:
+        await reserve_product_codes([product.code])
+
+    for _attempt in range(PRODUCT_CODE_ATTEMPTS if generated else 1):
+        if generated:
+            product.code = await generate_product_code()
+        product_obj = Product(**product.model_dump())
+        if await insert_new_product(product_obj):
+            await clear_tombstones([product_obj.code])
+            color_index.upsert(product_obj.code, product_obj.colorHex, product_obj.stockQty)
+            return product_obj
+    if generated:
+        raise HTTPException(status_code=503, detail="Could not allocate a free product code, please retry")
+    raise HTTPException(status_code=400, detail="Product code already exists")
+
+@api_router.post("/products/import", response_model=ImportReport)
+async def import_products(file: UploadFile = File(...), format: Optional[DataFormat] = None):
+    """Bulk-create products from a CSV or NDJSON upload, reporting errors per row"""
+    return await import_product_file(file.file, upload_format(file, format))
+
+@api_router.get("/products", response_model=List[Product])
+async def get_products(
+    category: Optional[ProductCategory] = None,
+    search: Optional[str] = None,
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    after = decode_cursor(cursor, ["code"])["code"] if cursor else None
+    query = product_list_query(category, search, after)
+    products = await db.products.find(query, PRODUCT_PROJECTION).sort(PRODUCT_LIST_SORT).limit(page_size + 1).to_list(length=page_size + 1)
+    return paginate(products, page_size, ["code"])
+
+@api_router.get("/products/similar-color", response_model=List[SimilarProduct])
+async def get_similar_color_products(
+    hex: str = Query(..., pattern=r"^#?[0-9A-Fa-f]{6}$"),
+    k: int = Query(5, ge=1, le=50),
+    in_stock: bool = True
+):
+    """Find the products whose color looks closest to a swatch (CIE76 delta E)"""
+    await color_index.ensure_loaded()
+    nearest = color_index.nearest(f"#{hex.lstrip('#')}", k, in_stock_only=in_stock)
+    if not nearest:
+        return []
+
+    products = {
+        product["code"]: product
+        async for product in db.products.find({"code": {"$in": [code for code, _ in nearest]}}, PRODUCT_PROJECTION)
+    }
+    return FastJSONResponse([
+        {**products[code], "deltaE": distance}
+        for code, distance in nearest
+        if code in products
+    ])
+
+@api_router.get("/products/changes", response_model=ProductChanges)
+async def get_product_changes(since: Optional[str] = None):
+    """Products changed and codes removed since a previous sync; no token means the full catalogue"""
+    now = datetime.now(timezone.utc)
+    changed_since = None
+    if since:
+        try:
+            changed_since = to_datetime(decode_cursor(since, ["changedAt"])["changedAt"]) - PRODUCT_SYNC_OVERLAP
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+        if changed_since < now - PRODUCT_TOMBSTONE_RETENTION:
+            changed_since = None
+
+    removed = []
+    if changed_since:
+        query = {"changedAt": {"$gte": changed_since}}
+        removed = [doc["_id"] async for doc in db.product_tombstones.find(query, {"_id": 1})]
+    else:
+        query = {}
+    changed = await db.products.find(query, PRODUCT_PROJECTION).sort("code", 1).to_list(length=None)
+    return FastJSONResponse({
+        "changed": changed,
+        "removed": removed,
+        "token": encode_cursor({"changedAt": now}),
+        "reset": changed_since is None,
+    })
 
 @api_router.get("/products/{product_code}", response_model=Product)
 async def get_product(product_code: str):
-    product = await db.products.find_one({"code": product_code})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    return Product(**parse_from_mongo(product))
+    product_obj = product_cache.get(product_code)
+    if not product_obj:
+        product = await db.products.find_one({"code": product_code}, PRODUCT_PROJECTION)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        product_obj = Product(**product)
+        product_cache.put(product_obj)
+    # Time to the first successful scan is the cold start number that matters
+    if "firstProductLookup" not in startup_timings:
+        startup_timings["firstProductLookup"] = startup_elapsed()
+    return product_obj
 
 @api_router.put("/products/{product_code}", response_model=Product)
 async def update_product(product_code: str, product_update: ProductUpdate):
-    update_data = {k: v for k, v in product_update.dict().items() if v is not None}
-    update_data["updatedAt"] = datetime.now(timezone.utc)
+    update_data = {k: v for k, v in product_update.model_dump().items() if v is not None}
+    update_data["updatedAt"] = update_data["changedAt"] = datetime.now(timezone.utc)
+    if "name" in update_data:
+        update_data["searchTerms"] = search_terms(update_data["name"], product_code)
     
-    result = await db.products.update_one(
+    product_cache.invalidate(product_code)
+    updated_product = await db.products.find_one_and_update(
         {"code": product_code},
-        {"$set": prepare_for_mongo(update_data)}
+        {"$set": update_data},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if not updated_product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    updated_product = await db.products.find_one({"code": product_code})
-    return Product(**parse_from_mongo(updated_product))
+    product_obj = Product(**updated_product)
+    product_cache.put(product_obj)
+    color_index.upsert(product_obj.code, product_obj.colorHex, product_obj.stockQty)
+    return product_obj
 
 @api_router.delete("/products/{product_code}")
 async def delete_product(product_code: str):
+    product_cache.invalidate(product_code)
+    color_index.remove(product_code)
     result = await db.products.delete_one({"code": product_code})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await db.product_tombstones.update_one(
+        {"_id": product_code},
+        {"$set": {"changedAt": datetime.now(timezone.utc)}},
+        upsert=True
+    )
     return {"message": "Product deleted successfully"}
 
 # Sales Routes
-@api_router.post("/sales", response_model=Sale)
-async def create_sale(sale: SaleCreate):
-    # Get product details
-    product = await db.products.find_one({"code": sale.productCode})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    # Check stock
-    if product["stockQty"] < sale.quantity:
-        raise HTTPException(status_code=400, detail="Insufficient stock")
-    
-    # Create sale record
-    sale_obj = Sale(
-        productCode=sale.productCode,
+SALE_PRODUCT_FIELDS = {"_id": 0, "code": 1, "name": 1, "price": 1, "colorName": 1, "colorHex": 1, "stockQty": 1}
+
+async def take_product_stock(code: str, quantity: int) -> Optional[Dict[str, Any]]:
+    """Take `quantity` units of one product if it has them, returning its updated snapshot"""
+    snapshot = await db.products.find_one_and_update(
+        {"code": code, "stockQty": {"$gte": quantity}},
+        {"$inc": {"stockQty": -quantity}, "$set": {"changedAt": datetime.now(timezone.utc)}},
+        projection=SALE_PRODUCT_FIELDS,
+        return_document=ReturnDocument.BEFORE
+    )
+    if snapshot:
+        snapshot["stockQty"] -= quantity
+        product_cache.set_stock(code, snapshot["stockQty"])
+        color_index.set_stock(code, snapshot["stockQty"])
+    return snapshot
+
+async def take_stock(quantities: Dict[str, int]) -> Dict[str, Dict[str, Any]]:
+    """Atomically decrement stock for each product, all or nothing.
+
+    Each product is taken with a single conditional find_one_and_update, so
+    concurrent sales can never drive stock negative, and the updated product
+    snapshot comes back in the same round trip. The per-product updates run
+    concurrently; if any product is missing or short, or its update fails,
+    the ones already taken are put back before raising.
+    """
+    codes = list(quantities)
+    outcomes = await asyncio.gather(*(take_product_stock(code, quantities[code]) for code in codes),
+                                    return_exceptions=True)
+    errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    products = {code: outcome for code, outcome in zip(codes, outcomes) if outcome and not isinstance(outcome, BaseException)}
+    missing = [code for code in codes if code not in products]
+    if not missing:
+        return products
+
+    await return_stock({code: quantities[code] for code in products})
+    if errors:
+        raise errors[0]
+    # Only the failure path pays for working out why the update didn't match
+    existing = await db.products.find_one({"code": missing[0]}, {"_id": 1})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Product not found" if len(codes) == 1 else f"Product not found: {missing[0]}")
+    raise HTTPException(status_code=400, detail="Insufficient stock" if len(codes) == 1 else f"Insufficient stock: {missing[0]}")
+
+async def return_product_stock(code: str, quantity: int):
+    """Put back `quantity` units of one product, updating the color index from its new stock level"""
+    product_cache.invalidate(code)
+    snapshot = await db.products.find_one_and_update(
+        {"code": code},
+        {"$inc": {"stockQty": quantity}, "$set": {"changedAt": datetime.now(timezone.utc)}},
+        projection={"_id": 0, "stockQty": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if snapshot:
+        color_index.set_stock(code, snapshot["stockQty"])
+
+async def return_stock(quantities: Dict[str, int]):
+    """Put back stock taken for sales that could not be recorded"""
+    await asyncio.gather(*(return_product_stock(code, quantity) for code, quantity in quantities.items()))
+
+def sale_from_product(product: Dict[str, Any], quantity: int) -> Sale:
+    """Build the sale record for `quantity` units of a product snapshot"""
+    return Sale(
+        productCode=product["code"],
         productName=product["name"],
         priceAtSale=product["price"],
         colorAtSale=f"{product['colorName']} ({product['colorHex']})",
-        quantity=sale.quantity
-    )
-    
-    sale_dict = prepare_for_mongo(sale_obj.dict())
-    
-    # Update stock and insert sale in transaction-like operation
-    await db.products.update_one(
-        {"code": sale.productCode},
-        {"$inc": {"stockQty": -sale.quantity}}
+        quantity=quantity
     )
-    
-    result = await db.sales.insert_one(sale_dict)
+
+# Sale write coalescing
+# Opt-in (SALE_COALESCE_WINDOW_MS > 0): single sales arriving within the
+# window are recorded together. Each product in the batch has its stock taken
+# with one conditional update for the total of its sales (all products
+# concurrently, falling back to sale by sale only when it is short), then one
+# insert_many records every sale and one rollup update counts them, instead
+# of a round trip of each per sale.
+SALE_COALESCE_WINDOW = float(os.environ.get("SALE_COALESCE_WINDOW_MS", "0")) / 1000
+SALE_COALESCE_MAX_BATCH = int(os.environ.get("SALE_COALESCE_MAX_BATCH", "200"))
+
+async def record_sale_batch(sales: List[SaleCreate]) -> List[Any]:
+    """Record single sales together, returning each one's Sale or the exception it failed with"""
+    by_product: Dict[str, List[int]] = {}
+    for index, sale in enumerate(sales):
+        by_product.setdefault(sale.productCode, []).append(index)
+    codes = list(by_product)
+    outcomes = await asyncio.gather(*(
+        take_queued_stock(code, [sales[index].quantity for index in by_product[code]]) for code in codes
+    ), return_exceptions=True)
+
+    results: List[Any] = [None] * len(sales)
+    untouched = []
+    for code, outcome in zip(codes, outcomes):
+        if isinstance(outcome, BaseException):
+            # Only the sales of a product whose update failed fail with it
+            for index in by_product[code]:
+                results[index] = outcome
+            continue
+        snapshot, flags = outcome
+        if snapshot is None:
+            untouched.append(code)
+        for index, ok in zip(by_product[code], flags):
+            if ok:
+                results[index] = sale_from_product(snapshot, sales[index].quantity)
+            elif snapshot is not None:
+                results[index] = HTTPException(status_code=400, detail="Insufficient stock")
+    recorded = [index for index, result in enumerate(results) if isinstance(result, Sale)]
+
+    # From here on, stock taken for sales that don't get recorded is put back
+    failed = set()
+    try:
+        if untouched:
+            existing = {doc["code"] async for doc in db.products.find({"code": {"$in": untouched}}, {"_id": 0, "code": 1})}
+            for code in untouched:
+                for index in by_product[code]:
+                    results[index] = (HTTPException(status_code=400, detail="Insufficient stock") if code in existing
+                                      else HTTPException(status_code=404, detail="Product not found"))
+        if recorded:
+            await db.sales.insert_many([sale_document(results[index]) for index in recorded], ordered=False)
+    except BulkWriteError as e:
+        failed = {recorded[write_error["index"]] for write_error in e.details["writeErrors"]}
+    except Exception:
+        failed = set(recorded)
+        raise
+    finally:
+        returned = {}
+        for index in failed:
+            returned[results[index].productCode] = returned.get(results[index].productCode, 0) + results[index].quantity
+        await return_stock(returned)
+    for index in failed:
+        results[index] = HTTPException(status_code=400, detail="Failed to create sale")
+    await record_sale_rollups([results[index] for index in recorded if index not in failed])
+    return results
+
+class SaleCoalescer:
+    """Collects single sales for `window` seconds (or up to `max_batch`) and records them together"""
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: List[Tuple[SaleCreate, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flushes = set()
+
+    async def submit(self, sale: SaleCreate) -> Sale:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((sale, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        # A till that disconnects doesn't pull its sale out of the batch
+        return await asyncio.shield(future)
+
+    def flush(self):
+        """Start recording the pending sales"""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.record(batch))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def record(self, batch: List[Tuple[SaleCreate, asyncio.Future]]):
+        started = time.perf_counter()
+        metrics.sale_batch_size.observe(len(batch))
+        try:
+            results = await record_sale_batch([sale for sale, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        metrics.sale_batch_duration.observe(time.perf_counter() - started)
+
+    async def drain(self):
+        """Record whatever is pending and wait for the batches in flight"""
+        self.flush()
+        await asyncio.gather(*self.flushes, return_exceptions=True)
+
+sale_coalescer = SaleCoalescer(SALE_COALESCE_WINDOW, SALE_COALESCE_MAX_BATCH) if SALE_COALESCE_WINDOW > 0 else None
+
+@api_router.post("/sales", response_model=Sale)
+async def create_sale(sale: SaleCreate):
+    if sale_coalescer:
+        return await sale_coalescer.submit(sale)
+    products = await take_stock({sale.productCode: sale.quantity})
+    sale_obj = sale_from_product(products[sale.productCode], sale.quantity)
+
+    try:
+        result = await db.sales.insert_one(sale_document(sale_obj))
+    except Exception:
+        await return_stock({sale.productCode: sale.quantity})
+        raise
     if result.inserted_id:
+        await record_sale_rollups([sale_obj])
         return sale_obj
+    await return_stock({sale.productCode: sale.quantity})
     raise HTTPException(status_code=400, detail="Failed to create sale")
 
+@api_router.post("/sales/checkout", response_model=List[Sale])
+async def checkout(cart: CheckoutRequest):
+    """Record a multi-item sale: stock for every line is taken or none is"""
+    quantities = {}
+    for item in cart.items:
+        quantities[item.productCode] = quantities.get(item.productCode, 0) + item.quantity
+
+    products = await take_stock(quantities)
+    sales = [sale_from_product(products[item.productCode], item.quantity) for item in cart.items]
+
+    docs = [sale_document(sale_obj) for sale_obj in sales]
+    try:
+        await db.sales.insert_many(docs)
+    except BulkWriteError as e:
+        # Ordered: the lines before the failing one were stored. Take them
+        # out again so the cart is recorded whole or not at all
+        stored = e.details["nInserted"]
+        try:
+            if stored:
+                await db.sales.delete_many({"_id": {"$in": [doc["_id"] for doc in docs[:stored]]}})
+        except Exception:
+            # They stay recorded: only the other lines' stock goes back
+            returned = {}
+            for sale_obj in sales[stored:]:
+                returned[sale_obj.productCode] = returned.get(sale_obj.productCode, 0) + sale_obj.quantity
+            await return_stock(returned)
+            await record_sale_rollups(sales[:stored])
+            raise
+        await return_stock(quantities)
+        raise HTTPException(status_code=400, detail="Failed to create sale")
+    except Exception:
+        await return_stock(quantities)
+        raise
+    await record_sale_rollups(sales)
+    return sales
+
+async def take_queued_stock(code: str, quantities: List[int]):
+    """Take stock for a product's queued sales, as many of them as it covers.
+
+    Returns the product snapshot (None if nothing was taken) and which sales
+    got their stock. Normally one update takes the total; only a product that
+    is short takes them one at a time, in queue order.
+    """
+    snapshot = await take_product_stock(code, sum(quantities))
+    if snapshot:
+        return snapshot, [True] * len(quantities)
+    taken = []
+    smallest_short = None
+    try:
+        for quantity in quantities:
+            # Stock only goes down meanwhile, so a quantity that didn't fit once won't later
+            taken_snapshot = None
+            if smallest_short is None or quantity < smallest_short:
+                taken_snapshot = await take_product_stock(code, quantity)
+            if taken_snapshot:
+                snapshot = taken_snapshot
+            else:
+                smallest_short = quantity if smallest_short is None else min(smallest_short, quantity)
+            taken.append(taken_snapshot is not None)
+    except Exception:
+        # The caller fails all of this product's sales, so put back what was taken
+        returned = sum(quantity for quantity, ok in zip(quantities, taken) if ok)
+        if returned:
+            await return_stock({code: returned})
+        raise
+    return snapshot, taken
+
+@api_router.post("/sales/sync", response_model=List[SaleSyncResult])
+async def sync_sales(batch: SaleSyncRequest):
+    """Record sales queued by a till while offline.
+
+    Every sale carries a client-generated idempotency key, stored with it
+    under a unique index, so a batch that is retried after a dropped
+    connection reports the sales already recorded as duplicates instead of
+    recording them twice. Sales are accepted or rejected individually.
+    """
+    queued = {}
+    for sale in batch.sales:
+        queued.setdefault(sale.idempotencyKey, sale)
+
+    results: Dict[str, SaleSyncResult] = {}
+    async for doc in db.sales.find({"idempotencyKey": {"$in": list(queued)}}, {**SALE_PROJECTION, "idempotencyKey": 1}):
+        key = doc.pop("idempotencyKey")
+        results[key] = SaleSyncResult(idempotencyKey=key, status=SaleSyncStatus.DUPLICATE, sale=Sale(**doc))
+    unseen = [key for key in queued if key not in results]
+    if unseen:
+        # A sale queued long enough ago (by its client timestamp) may have
+        # been archived since it was first synced
+        archived = {"sales.idempotencyKey": {"$in": unseen}}
+        async for doc in db.sales_archive.aggregate([
+            {"$match": archived},
+            {"$unwind": "$sales"},
+            {"$match": archived},
+            {"$project": {**ARCHIVED_SALE_FIELDS, "idempotencyKey": "$sales.idempotencyKey"}},
+        ]):
+            key = doc.pop("idempotencyKey")
+            results[key] = SaleSyncResult(idempotencyKey=key, status=SaleSyncStatus.DUPLICATE, sale=Sale(**doc))
+
+    by_product: Dict[str, List[QueuedSale]] = {}
+    for key, sale in queued.items():
+        if key not in results:
+            by_product.setdefault(sale.productCode, []).append(sale)
+    codes = list(by_product)
+    taken = await asyncio.gather(*(
+        take_queued_stock(code, [sale.quantity for sale in by_product[code]]) for code in codes
+    ), return_exceptions=True)
+
+    now = datetime.now(timezone.utc)
+    recorded = []
+    short: List[Tuple[QueuedSale, bool]] = []
+    for code, outcome in zip(codes, taken):
+        if isinstance(outcome, BaseException):
+            # Only the sales of a product whose update failed fail with it;
+            # they get no result and are reported as failed below
+            logger.warning(f"Could not take stock for queued sales of {code}: {outcome}")
+            continue
+        snapshot, flags = outcome
+        for sale, ok in zip(by_product[code], flags):
+            if not ok:
+                short.append((sale, snapshot is None))
+                continue
+            sale_obj = sale_from_product(snapshot, sale.quantity)
+            if sale.timestamp:
+                sale_obj.timestamp = min(as_utc(sale.timestamp), now)
+            recorded.append((sale.idempotencyKey, sale_obj))
+
+    # From here on, stock taken for sales that don't get recorded is put back
+    failed = {}
+    try:
+        untouched = list({sale.productCode for sale, none_taken in short if none_taken})
+        existing = set()
+        if untouched:
+            existing = {doc["code"] async for doc in db.products.find({"code": {"$in": untouched}}, {"_id": 0, "code": 1})}
+        for sale, none_taken in short:
+            error = "Product not found" if none_taken and sale.productCode not in existing else "Insufficient stock"
+            results[sale.idempotencyKey] = SaleSyncResult(
+                idempotencyKey=sale.idempotencyKey, status=SaleSyncStatus.REJECTED, error=error)
+        if recorded:
+            docs = [{**sale_document(sale_obj), "idempotencyKey": key} for key, sale_obj in recorded]
+            await db.sales.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        failed = {write_error["index"]: write_error for write_error in e.details["writeErrors"]}
+    except Exception:
+        failed = dict.fromkeys(range(len(recorded)))
+        raise
+    finally:
+        returned = {}
+        for index in failed:
+            sale_obj = recorded[index][1]
+            returned[sale_obj.productCode] = returned.get(sale_obj.productCode, 0) + sale_obj.quantity
+        await return_stock(returned)
+
+    raced = []
+    for index, (key, sale_obj) in enumerate(recorded):
+        if index not in failed:
+            results[key] = SaleSyncResult(idempotencyKey=key, status=SaleSyncStatus.RECORDED, sale=sale_obj)
+        elif failed[index]["code"] == 11000:
+            # The same key was recorded by a concurrent retry of this batch
+            raced.append(key)
+        else:
+            results[key] = SaleSyncResult(idempotencyKey=key, status=SaleSyncStatus.REJECTED, error=failed[index]["errmsg"])
+    async for doc in db.sales.find({"idempotencyKey": {"$in": raced}}, {**SALE_PROJECTION, "idempotencyKey": 1}):
+        key = doc.pop("idempotencyKey")
+        results[key] = SaleSyncResult(idempotencyKey=key, status=SaleSyncStatus.DUPLICATE, sale=Sale(**doc))
+    await record_sale_rollups([sale_obj for index, (_, sale_obj) in enumerate(recorded) if index not in failed])
+
+    # A key repeated within the batch is a duplicate of its first occurrence
+    first = set()
+    response = []
+    for sale in batch.sales:
+        result = results.get(sale.idempotencyKey) or SaleSyncResult(
+            idempotencyKey=sale.idempotencyKey, status=SaleSyncStatus.REJECTED, error="Failed to record sale")
+        if sale.idempotencyKey in first and result.sale:
+            result = result.model_copy(update={"status": SaleSyncStatus.DUPLICATE})
+        first.add(sale.idempotencyKey)
+        response.append(result)
+    return response
+
+SALES_LIST_SORT = [("timestamp", DESCENDING), ("id", DESCENDING)]
+
+def sales_before(position: Dict[str, Any]) -> Dict[str, Any]:
+    """Filter on the sales that come after `position` in newest-first order"""
+    return {"$or": [
+        {"timestamp": {"$lt": position["timestamp"]}},
+        {"timestamp": position["timestamp"], "id": {"$lt": position["id"]}}
+    ]}
+
+def sales_list_query(search: Optional[str], position: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """The filter GET /api/sales pages through recent sales with, in SALES_LIST_SORT order"""
+    query = search_filter(search) if search else {}
+    if position:
+        query = {"$and": query.get("$and", []) + [sales_before(position)]}
+    return query
+
+def archive_list_query(search: Optional[str], position: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """The bucket filter GET /api/sales reads the archive's part of a page with"""
+    query = search_filter(search) if search else {}
+    if position:
+        # Only buckets holding sales older than the position, newest day first
+        query["day"] = {"$lte": archive_day(position["timestamp"])}
+        query["from"] = {"$lte": position["timestamp"]}
+    return query
+
 @api_router.get("/sales", response_model=List[Sale])
-async def get_sales(limit: int = 100, search: Optional[str] = None):
-    query = {}
-    if search:
-        query["$or"] = [
-            {"productName": {"$regex": search, "$options": "i"}},
-            {"productCode": {"$regex": search, "$options": "i"}}
-        ]
-    
-    sales = await db.sales.find(query).sort("timestamp", -1).limit(limit).to_list(length=limit)
-    return [Sale(**parse_from_mongo(sale)) for sale in sales]
+async def get_sales(
+    search: Optional[str] = None,
+    page_size: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Deprecated alias of page_size")
+):
+    page_size = page_size or limit or DEFAULT_PAGE_SIZE
+    position = None
+    if cursor:
+        position = decode_cursor(cursor, ["timestamp", "id"])
+        try:
+            position["timestamp"] = to_datetime(position["timestamp"])
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    query = sales_list_query(search, position)
+
+    sales = await db.sales.find(query, SALE_PROJECTION).sort(SALES_LIST_SORT).limit(page_size + 1).to_list(length=page_size + 1)
+    # Sales synced late from a till queue can sit in db.sales with timestamps
+    # older than archived ones, so the page is both tiers merged in
+    # SALES_LIST_SORT order, not the recent sales followed by the archive
+    bucket_query = archive_list_query(search, position)
+    if len(sales) > page_size:
+        # Only archived sales newer than the last recent one can make the
+        # page; usually no bucket is that new and the archive costs one lookup
+        last = sales[-1]["timestamp"]
+        bucket_query = {"$and": [bucket_query, {"day": {"$gte": archive_day(last)}, "to": {"$gte": last}}]}
+    listed = {sale["id"] for sale in sales}
+    async for sale in archived_sales(bucket_query, sales_before(position) if position else {},
+                                     descending=True, limit=page_size + 1):
+        # Sales still being archived can briefly be in both tiers
+        if sale["id"] not in listed:
+            sales.append(sale)
+    sales.sort(key=lambda sale: (sale["timestamp"], sale["id"]), reverse=True)
+    return paginate(sales, page_size, ["timestamp", "id"])
 
 # Dashboard Routes
-@api_router.get("/dashboard/stats", response_model=DashboardStats)
-async def get_dashboard_stats():
-    # Calculate date ranges
-    now = datetime.now(timezone.utc)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    
-    # Revenue calculations
-    today_sales = await db.sales.find({"timestamp": {"$gte": today_start.isoformat()}}).to_list(length=None)
-    month_sales = await db.sales.find({"timestamp": {"$gte": month_start.isoformat()}}).to_list(length=None)
-    all_sales = await db.sales.find().to_list(length=None)
-    
-    total_revenue = {
-        "today": sum(sale["priceAtSale"] * sale["quantity"] for sale in today_sales),
-        "month": sum(sale["priceAtSale"] * sale["quantity"] for sale in month_sales),
-        "allTime": sum(sale["priceAtSale"] * sale["quantity"] for sale in all_sales)
-    }
-    
-    total_units = {
-        "today": sum(sale["quantity"] for sale in today_sales),
-        "month": sum(sale["quantity"] for sale in month_sales),
-        "allTime": sum(sale["quantity"] for sale in all_sales)
-    }
-    
-    # Distinct products
-    distinct_products = {
-        "today": len(set(sale["productCode"] for sale in today_sales)),
-        "month": len(set(sale["productCode"] for sale in month_sales)),
-        "allTime": len(set(sale["productCode"] for sale in all_sales))
-    }
-    
+# Every open dashboard polls the same stats, so they are computed once per
+# DASHBOARD_CACHE_TTL seconds: concurrent requests share one in-flight
+# computation, and recording a sale on this worker drops the cached copy.
+# The ETag is a hash of the rendered body, so it agrees across workers.
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", "2"))
+
+class DashboardCache:
+    """Single-flight, short-TTL cache of the rendered dashboard stats"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entry = None
+        self.inflight = None
+        self.generation = 0
+
+    async def get(self, compute) -> tuple:
+        """Return (body, etag), computing them at most once at a time"""
+        if self.entry and self.entry[0] > time.monotonic():
+            return self.entry[1], self.entry[2]
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.refresh(compute, self.generation))
+        # Shielded so a client disconnecting doesn't cancel it for the others
+        return await asyncio.shield(self.inflight)
+
+    async def refresh(self, compute, generation: int) -> tuple:
+        try:
+            body = orjson.dumps((await compute()).model_dump(), option=orjson.OPT_UTC_Z)
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            # A sale recorded meanwhile makes this result stale: hand it to
+            # the requests already waiting, but don't cache it
+            if generation == self.generation:
+                self.entry = (time.monotonic() + self.ttl, body, etag)
+            return body, etag
+        finally:
+            if generation == self.generation:
+                self.inflight = None
+
+    def invalidate(self):
+        self.generation += 1
+        self.entry = None
+        # Requests from now on must not join a computation that started
+        # before the sale
+        self.inflight = None
+
+dashboard_cache = DashboardCache(DASHBOARD_CACHE_TTL)
+
+async def compute_dashboard_stats() -> DashboardStats:
+    today, month, all_time = rollup_periods(datetime.now(timezone.utc))
+    periods = {"today": today, "month": month, "allTime": all_time}
+
+    totals = {}
+    async for doc in db.sales_totals.find({"_id": {"$in": list(periods.values())}}):
+        totals[doc["_id"]] = doc
+
+    def period_total(field, period):
+        return totals.get(period, {}).get(field, 0)
+
+    total_revenue = {name: float(period_total("revenue", period)) for name, period in periods.items()}
+    total_units = {name: period_total("units", period) for name, period in periods.items()}
+    distinct_products = {name: period_total("distinctProducts", period) for name, period in periods.items()}
+
     # Top sellers
-    product_stats = {}
-    for sale in all_sales:
-        code = sale["productCode"]
-        if code not in product_stats:
-            product_stats[code] = {
-                "productName": sale["productName"],
-                "totalUnits": 0,
-                "totalRevenue": 0
-            }
-        product_stats[code]["totalUnits"] += sale["quantity"]
-        product_stats[code]["totalRevenue"] += sale["priceAtSale"] * sale["quantity"]
-    
-    top_sellers = sorted(
-        [{"productCode": code, **stats} for code, stats in product_stats.items()],
-        key=lambda x: x["totalRevenue"],
-        reverse=True
-    )[:10]
+    top_rollups = await db.sales_rollups.find(
+        {"period": ROLLUP_ALL_TIME},
+        {"_id": 0, "productCode": 1, "productName": 1, "units": 1, "revenue": 1}
+    ).sort("revenue", -1).limit(10).to_list(length=10)
+    top_sellers = [
+        {
+            "productCode": rollup["productCode"],
+            "productName": rollup["productName"],
+            "totalUnits": rollup["units"],
+            "totalRevenue": rollup["revenue"]
+        }
+        for rollup in top_rollups
+    ]
     
     return DashboardStats(
         totalRevenue=total_revenue,
@@ -324,72 +2116,643 @@ async def get_dashboard_stats():
         topSellers=top_sellers
     )
 
+@api_router.get("/dashboard/stats", response_model=DashboardStats)
+async def get_dashboard_stats(if_none_match: Optional[str] = Header(None)):
+    body, etag = await dashboard_cache.get(compute_dashboard_stats)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Analytics Routes
+MAX_ANALYTICS_BUCKETS = 5000
+GRANULARITY_SPAN = {
+    AnalyticsGranularity.HOUR: timedelta(hours=1),
+    AnalyticsGranularity.DAY: timedelta(days=1),
+    AnalyticsGranularity.WEEK: timedelta(weeks=1),
+    AnalyticsGranularity.MONTH: timedelta(days=28),
+}
+
+def sales_analytics_pipeline(start: datetime, end: datetime, granularity: AnalyticsGranularity,
+                             group_by: Optional[AnalyticsGroupBy], tz: str) -> List[Dict[str, Any]]:
+    """Build the aggregation pipeline that buckets sales server-side.
+
+    Buckets come back one document each (not gathered into a single $facet
+    document), so a fine granularity times many groups can't exceed the 16 MB
+    document limit.
+    """
+    bucket_start = {"date": "$timestamp", "unit": granularity.value, "timezone": tz}
+    if granularity == AnalyticsGranularity.WEEK:
+        bucket_start["startOfWeek"] = "monday"
+
+    bucket_group = {"bucket": "$bucket"}
+    if group_by == AnalyticsGroupBy.CATEGORY:
+        # Sales don't carry a category, so group by product first and look the
+        # category up once per product and bucket rather than once per sale
+        bucket_group["group"] = "$productCode"
+    elif group_by:
+        bucket_group["group"] = f"${group_by.value}"
+
+    stages = [
+        {"$group": {
+            "_id": bucket_group,
+            "revenue": {"$sum": "$revenue"},
+            "units": {"$sum": "$quantity"},
+            "salesCount": {"$sum": 1},
+        }},
+    ]
+    if group_by == AnalyticsGroupBy.CATEGORY:
+        stages += [
+            {"$lookup": {"from": "products", "localField": "_id.group", "foreignField": "code", "as": "product"}},
+            {"$group": {
+                "_id": {
+                    "bucket": "$_id.bucket",
+                    "group": {"$ifNull": [{"$arrayElemAt": ["$product.category", 0]}, "unknown"]},
+                },
+                "revenue": {"$sum": "$revenue"},
+                "units": {"$sum": "$units"},
+                "salesCount": {"$sum": "$salesCount"},
+            }},
+        ]
+    stages += [
+        {"$sort": {"_id.bucket": 1, "_id.group": 1}},
+        {"$project": {
+            "_id": 0,
+            "start": "$_id.bucket",
+            "group": "$_id.group",
+            "revenue": 1,
+            "units": 1,
+            "salesCount": 1,
+        }},
+    ]
+
+    in_range = {"$match": {"timestamp": {"$gte": start, "$lt": end}}}
+    return [
+        in_range,
+        {"$unionWith": {
+            "coll": "sales_archive",
+            "pipeline": [{"$match": archive_range_filter(start, end)}, *ARCHIVED_SALE_STAGES, in_range],
+        }},
+        {"$project": {
+            "_id": 0,
+            "productCode": 1,
+            "colorAtSale": 1,
+            "quantity": 1,
+            "revenue": {"$multiply": ["$priceAtSale", "$quantity"]},
+            "timestamp": 1,
+        }},
+        {"$addFields": {"bucket": {"$dateTrunc": bucket_start}}},
+        *stages,
+    ]
+
+@api_router.get("/analytics/sales", response_model=SalesAnalytics)
+async def get_sales_analytics(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    granularity: AnalyticsGranularity = AnalyticsGranularity.DAY,
+    group_by: Optional[AnalyticsGroupBy] = None,
+    tz: str = "UTC"
+):
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=30)
+    start, end = as_utc(start), as_utc(end)
+
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    try:
+        ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail="Unknown timezone")
+    if (end - start) / GRANULARITY_SPAN[granularity] > MAX_ANALYTICS_BUCKETS:
+        raise HTTPException(status_code=400, detail="Date range too large for this granularity")
+
+    pipeline = sales_analytics_pipeline(start, end, granularity, group_by, tz)
+    # Every sale lands in exactly one bucket, so the totals are the buckets' sums
+    buckets = []
+    totals = {"revenue": 0, "units": 0, "salesCount": 0}
+    async for bucket in db.sales.aggregate(pipeline, allowDiskUse=True):
+        buckets.append(SalesBucket(**bucket))
+        for field in totals:
+            totals[field] += bucket[field]
+
+    return SalesAnalytics(
+        start=start,
+        end=end,
+        granularity=granularity,
+        groupBy=group_by,
+        buckets=buckets,
+        totals=totals
+    )
+
+# Export Routes
+# Exports iterate their cursors and flush every EXPORT_BATCH_SIZE rows, so
+# memory stays flat however many rows are streamed out
+EXPORT_BATCH_SIZE = 1000
+PRODUCT_EXPORT_FIELDS = ["code", "name", "colorName", "colorHex", "price", "category", "stockQty", "createdAt", "updatedAt"]
+SALE_EXPORT_FIELDS = ["id", "productCode", "productName", "priceAtSale", "colorAtSale", "quantity", "timestamp"]
+EXPORT_MEDIA_TYPES = {DataFormat.CSV: "text/csv", DataFormat.NDJSON: "application/x-ndjson"}
+
+def export_value(value):
+    """Render a stored value for export"""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+async def export_rows(docs, fields: List[str], format: DataFormat):
+    """Stream documents as CSV or NDJSON text, one batch at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == DataFormat.CSV:
+        writer.writerow(fields)
+    rows = 0
+    async for doc in docs:
+        values = [export_value(doc.get(field)) for field in fields]
+        if format == DataFormat.CSV:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, values))) + "\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def date_range_filter(field: str, start: Optional[datetime], end: Optional[datetime]) -> Dict[str, Any]:
+    """Filter on a stored date field within [start, end)"""
+    bounds = {}
+    if start:
+        bounds["$gte"] = as_utc(start)
+    if end:
+        bounds["$lt"] = as_utc(end)
+    return {field: bounds} if bounds else {}
+
+def export_response(docs, fields: List[str], format: DataFormat, name: str) -> StreamingResponse:
+    return StreamingResponse(
+        export_rows(docs, fields, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format.value}"'}
+    )
+
+def product_export_docs(start: Optional[datetime], end: Optional[datetime]):
+    """The catalogue, optionally only products updated within [start, end)"""
+    return db.products.find(
+        date_range_filter("updatedAt", start, end),
+        {"_id": 0, **{field: 1 for field in PRODUCT_EXPORT_FIELDS}}
+    ).sort("code", 1).batch_size(EXPORT_BATCH_SIZE)
+
+def sale_export_docs(start: Optional[datetime], end: Optional[datetime]):
+    """The sales ledger in time order, optionally within [start, end)"""
+    in_range = date_range_filter("timestamp", start, end)
+    # Archived sales are the older ones, so they come first
+    archived = archived_sales(archive_range_filter(start, end), in_range)
+    cursor = db.sales.find(
+        in_range,
+        {"_id": 0, **{field: 1 for field in SALE_EXPORT_FIELDS}}
+    ).sort("timestamp", 1)
+    return chain_async(archived, cursor.batch_size(EXPORT_BATCH_SIZE))
+
+@api_router.get("/export/products")
+async def export_products(format: DataFormat = DataFormat.NDJSON, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Stream the catalogue, optionally only products updated within [start, end)"""
+    return export_response(product_export_docs(start, end), PRODUCT_EXPORT_FIELDS, format, "products")
+
+@api_router.get("/export/sales")
+async def export_sales(format: DataFormat = DataFormat.NDJSON, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Stream the sales ledger in time order, optionally within [start, end)"""
+    return export_response(sale_export_docs(start, end), SALE_EXPORT_FIELDS, format, "sales")
+
 # Color Detection Route
+def check_rgb(r: int, g: int, b: int):
+    if not all(0 <= channel <= 255 for channel in (r, g, b)):
+        raise HTTPException(status_code=400, detail="RGB values must be between 0 and 255")
+
 @api_router.post("/detect-color", response_model=ColorDetection)
 async def detect_color(rgb_data: Dict[str, int]):
     """Detect color name from RGB values"""
     r, g, b = rgb_data["r"], rgb_data["g"], rgb_data["b"]
-    
-    # Convert RGB to HSV
-    r_norm, g_norm, b_norm = r/255.0, g/255.0, b/255.0
-    max_val = max(r_norm, g_norm, b_norm)
-    min_val = min(r_norm, g_norm, b_norm)
-    diff = max_val - min_val
-    
-    # Calculate HSV
-    if diff == 0:
-        hue = 0
-    elif max_val == r_norm:
-        hue = (60 * ((g_norm - b_norm) / diff) + 360) % 360
-    elif max_val == g_norm:
-        hue = (60 * ((b_norm - r_norm) / diff) + 120) % 360
-    else:
-        hue = (60 * ((r_norm - g_norm) / diff) + 240) % 360
-    
-    saturation = 0 if max_val == 0 else diff / max_val
-    value = max_val
-    
-    # Color classification
-    hex_color = f"#{r:02x}{g:02x}{b:02x}"
-    confidence = 0.8
-    
-    # Enhanced color detection logic
-    if value < 0.15:
-        color_name = ColorName.BLACK
-    elif saturation < 0.1:
-        if value > 0.9:
-            color_name = ColorName.WHITE
-        elif value > 0.6:
-            color_name = ColorName.LIGHT_GREY
-        elif value > 0.3:
-            color_name = ColorName.GREY
-        else:
-            color_name = ColorName.DARK_GREY
-    else:
-        # Color detection based on hue ranges
-        if 0 <= hue < 15 or 345 <= hue < 360:
-            color_name = ColorName.DARK_RED if value < 0.5 else (ColorName.LIGHT_RED if value > 0.8 and saturation < 0.7 else ColorName.RED)
-        elif 15 <= hue < 45:
-            color_name = ColorName.ORANGE if saturation > 0.5 else ColorName.BROWN
-        elif 45 <= hue < 75:
-            color_name = ColorName.LIGHT_YELLOW if value > 0.8 else ColorName.YELLOW
-        elif 75 <= hue < 150:
-            color_name = ColorName.LIGHT_GREEN if value > 0.7 and saturation < 0.6 else (ColorName.DARK_GREEN if value < 0.4 else ColorName.GREEN)
-        elif 150 <= hue < 210:
-            color_name = ColorName.LIGHT_BLUE if value > 0.7 and saturation < 0.6 else (ColorName.DARK_BLUE if value < 0.4 else ColorName.BLUE)
-        elif 210 <= hue < 270:
-            color_name = ColorName.LIGHT_PURPLE if value > 0.7 and saturation < 0.6 else (ColorName.DARK_PURPLE if value < 0.4 else ColorName.PURPLE)
-        elif 270 <= hue < 330:
-            color_name = ColorName.LIGHT_PINK if value > 0.8 and saturation < 0.5 else ColorName.PINK
-        else:
-            color_name = ColorName.MAROON if value < 0.4 else ColorName.RED
+    check_rgb(r, g, b)
+    hue, saturation, value = colors.rgb_to_hsv(r, g, b)
+    color_name = colors.classify_rgb_value(r, g, b)
     
     return ColorDetection(
-        hex=hex_color,
+        hex=f"#{r:02x}{g:02x}{b:02x}",
         rgb={"r": r, "g": g, "b": b},
         hsv={"h": hue, "s": saturation, "v": value},
-        name=color_name,
-        confidence=confidence
+        name=ColorName(color_name),
+        confidence=0.8
+    )
+
+@api_router.post("/detect-color/batch", response_model=ColorBatchDetection)
+async def detect_color_batch(batch: ColorSamples):
+    """Classify many [r, g, b] samples (e.g. a whole camera frame) in one vectorized lookup"""
+    import numpy as np
+    try:
+        rgb = np.asarray(batch.samples, dtype=np.int64)
+    except (ValueError, OverflowError):
+        rgb = None
+    if rgb is None or rgb.ndim != 2 or rgb.shape[1] != 3:
+        raise HTTPException(status_code=400, detail="Samples must be [r, g, b] triples")
+    if rgb.min() < 0 or rgb.max() > 255:
+        raise HTTPException(status_code=400, detail="RGB values must be between 0 and 255")
+
+    indexes = colors.classify_rgb_lut(rgb, load=False)
+    counts = np.bincount(indexes, minlength=len(colors.COLOR_NAMES))
+    return ColorBatchDetection(
+        names=[colors.COLOR_NAMES[index] for index in indexes.tolist()],
+        hex=[f"#{r:02x}{g:02x}{b:02x}" for r, g, b in rgb.tolist()],
+        counts={colors.COLOR_NAMES[index]: int(count) for index, count in enumerate(counts) if count},
+        dominant=colors.COLOR_NAMES[int(counts.argmax())]
+    )
+
+# Image analysis decodes and classifies photos on CPU, so it runs in a process
+# pool and never blocks the event loop that is serving scans and sales
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# Photos are rejected above this many decoded pixels (JPEGs after decoder
+# downscaling): a small compressed PNG can otherwise decode to gigabytes
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", "24000000"))
+# Each API worker has its own pool, so by default they split the cores
+COLOR_POOL_WORKERS = int(os.environ.get("COLOR_POOL_WORKERS", "0")) or max(1, os.cpu_count() // WEB_CONCURRENCY)
+color_pool = None
+
+def get_color_pool() -> ProcessPoolExecutor:
+    global color_pool
+    if color_pool is None:
+        # spawn, not fork: the server process has Motor's threads running
+        color_pool = ProcessPoolExecutor(
+            max_workers=COLOR_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return color_pool
+
+def replace_broken_color_pool(broken: ProcessPoolExecutor):
+    """Swap in a fresh pool after a worker process died, unless another request already did"""
+    global color_pool
+    if color_pool is broken:
+        color_pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+@api_router.post("/detect-color/image", response_model=ImageColorDetection)
+async def detect_image_colors(file: UploadFile = File(...), k: int = Query(3, ge=1, le=8)):
+    """Extract the k dominant named colors from a photo of the fabric"""
+    data = await file.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+    # Pillow is only imported once a photo arrives, keeping it off the cold start path
+    from PIL import Image
+
+    pool = get_color_pool()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            pool, functools.partial(colors.dominant_colors, data, k, max_pixels=MAX_IMAGE_PIXELS))
+    except colors.ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"Image too large: {e}")
+    except (OSError, Image.DecompressionBombError):
+        raise HTTPException(status_code=400, detail="Could not read image")
+    except BrokenProcessPool:
+        # A worker process died (e.g. killed for memory); every later call
+        # on this pool would fail too
+        replace_broken_color_pool(pool)
+        raise HTTPException(status_code=503, detail="Image analysis was interrupted, please retry")
+    return ImageColorDetection(**result)
+
+# Cache Routes
+@api_router.get("/cache/stats")
+async def get_cache_stats():
+    return {"products": product_cache.stats()}
+
+# Metrics Routes
+@api_router.get("/metrics")
+async def get_metrics():
+    """Request and database command metrics in the Prometheus text format"""
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+# Admin Routes
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries():
+    """Recent commands slower than SLOW_QUERY_MS, newest first"""
+    return {
+        "enabled": slow_query_log is not None,
+        "thresholdMs": SLOW_QUERY_MS if slow_query_log else None,
+        "queries": slow_query_log.snapshot() if slow_query_log else [],
+    }
+
+@api_router.delete("/admin/slow-queries")
+async def clear_slow_queries():
+    if slow_query_log:
+        slow_query_log.clear()
+    return {"message": "Slow query log cleared"}
+
+@api_router.get("/admin/startup")
+async def get_startup_timings():
+    """Per-phase startup timings in milliseconds, since this module started importing"""
+    return {"mode": STARTUP_MODE, "ready": app_ready, "timings": startup_timings}
+
+# Jobs
+# Long-running work (rollup rebuilds, archiving, exports, imports) can run as
+# a job instead of inside the request: the request stores a job record in
+# db.jobs and returns 202 straight away, and the job runs on this worker's
+# bounded pool of JOB_WORKERS tasks, reporting progress on its record. Clients
+# poll /api/jobs/{id}; job output (exports) is kept in db.job_files chunks so
+# any worker can serve /api/jobs/{id}/result. Jobs running on a worker that
+# stops stop heartbeating and are reported as failed.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "100"))
+JOB_RETENTION = timedelta(days=int(os.environ.get("JOB_RETENTION_DAYS", "7")))
+JOB_HEARTBEAT_INTERVAL = 10.0
+JOB_STALE_AFTER = timedelta(seconds=3 * JOB_HEARTBEAT_INTERVAL)
+# Progress is written at most this often (seconds)
+JOB_PROGRESS_INTERVAL = 1.0
+JOB_PROJECTION = {"_id": 0, **{field: 1 for field in Job.model_fields}}
+ACTIVE_JOB_STATUSES = [JobStatus.QUEUED.value, JobStatus.RUNNING.value]
+
+class JobContext:
+    """Handed to a running job to report its progress and store its output"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.reported = 0.0
+        self.chunks = 0
+
+    async def progress(self, done: int, total: Optional[int] = None, force: bool = False):
+        if not force and time.monotonic() - self.reported < JOB_PROGRESS_INTERVAL:
+            return
+        self.reported = time.monotonic()
+        update = {"progress.done": done}
+        if total is not None:
+            update["progress.total"] = total
+        await db.jobs.update_one({"_id": self.job_id}, {"$set": update})
+
+    async def write(self, data: bytes):
+        await db.job_files.insert_one({
+            "jobId": self.job_id, "n": self.chunks, "data": data, "createdAt": datetime.now(timezone.utc)
+        })
+        self.chunks += 1
+
+class JobRunner:
+    """Runs queued jobs on `workers` tasks of this process"""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.queued = set()
+        self.running: Dict[str, asyncio.Task] = {}
+        self.cancelled = set()
+
+    def start(self):
+        for _ in range(self.workers):
+            run_in_background(self.run_jobs())
+        run_in_background(self.watch_jobs())
+
+    async def submit(self, kind: JobKind, params: Dict[str, Any], run, discard=None) -> Job:
+        """Record a job and queue `run(context)` to carry it out.
+
+        `discard()`, if given, runs instead when the job never starts (it was
+        cancelled while queued, or the worker stops first).
+        """
+        if self.queue.full():
+            raise HTTPException(status_code=503, detail="Too many jobs queued, try again later")
+        job = Job(kind=kind, params=params)
+        await db.jobs.insert_one({"_id": job.id, **job.model_dump(), "heartbeatAt": job.createdAt})
+        self.queued.add(job.id)
+        self.queue.put_nowait((job.id, run, discard))
+        return job
+
+    def discard_queued(self):
+        """Drop the jobs that haven't started, when the worker stops"""
+        while not self.queue.empty():
+            job_id, _, discard = self.queue.get_nowait()
+            self.queued.discard(job_id)
+            if discard:
+                discard()
+
+    def cancel(self, job_id: str):
+        """Cancel a job if it is running on this worker"""
+        task = self.running.get(job_id)
+        if task:
+            self.cancelled.add(job_id)
+            task.cancel()
+
+    async def run_jobs(self):
+        while True:
+            job_id, run, discard = await self.queue.get()
+            self.queued.discard(job_id)
+            now = datetime.now(timezone.utc)
+            # Jobs cancelled while queued are skipped; one that can't be
+            # claimed stops heartbeating and is reported as failed
+            try:
+                claimed = (await db.jobs.update_one(
+                    {"_id": job_id, "status": JobStatus.QUEUED.value},
+                    {"$set": {"status": JobStatus.RUNNING.value, "startedAt": now, "heartbeatAt": now}}
+                )).modified_count
+            except Exception as e:
+                logger.warning(f"Could not start job {job_id}: {e}")
+                claimed = False
+            if not claimed:
+                if discard:
+                    discard()
+                continue
+            task = asyncio.ensure_future(run(JobContext(job_id)))
+            self.running[job_id] = task
+            update = {}
+            try:
+                update = {"status": JobStatus.SUCCEEDED.value, "result": await task}
+            except asyncio.CancelledError:
+                if job_id not in self.cancelled:
+                    # The server is stopping
+                    await finish_job(job_id, {"status": JobStatus.FAILED.value, "error": "Interrupted by a restart"})
+                    raise
+                update = {"status": JobStatus.CANCELLED.value}
+            except HTTPException as e:
+                update = {"status": JobStatus.FAILED.value, "error": e.detail}
+            except Exception as e:
+                logger.error(f"Job {job_id} failed", exc_info=e)
+                update = {"status": JobStatus.FAILED.value, "error": str(e) or type(e).__name__}
+            finally:
+                self.running.pop(job_id, None)
+                self.cancelled.discard(job_id)
+            await finish_job(job_id, update)
+
+    async def watch_jobs(self):
+        """Heartbeat this worker's jobs and pick up cancellations made through other workers"""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            active = list(self.queued) + list(self.running)
+            if not active:
+                continue
+            try:
+                await db.jobs.update_many({"_id": {"$in": active}}, {"$set": {"heartbeatAt": datetime.now(timezone.utc)}})
+                async for doc in db.jobs.find({"_id": {"$in": list(self.running)}, "cancelRequested": True}, {"_id": 1}):
+                    self.cancel(doc["_id"])
+            except Exception as e:
+                logger.warning(f"Job heartbeat failed, retrying: {e}")
+
+job_runner = JobRunner(JOB_WORKERS, JOB_QUEUE_SIZE)
+
+# Import jobs read a temp copy of the upload named after the worker's pid
+IMPORT_FILE_PREFIX = "import-"
+
+def remove_stale_import_files():
+    """Delete upload copies left behind by worker processes that have stopped"""
+    for path in Path(tempfile.gettempdir()).glob(f"{IMPORT_FILE_PREFIX}*"):
+        pid = path.name[len(IMPORT_FILE_PREFIX):].split("-")[0]
+        if pid.isdigit() and pid_running(int(pid)):
+            continue
+        try:
+            path.unlink()
+        except OSError as e:
+            logger.warning(f"Could not delete leftover import file {path}: {e}")
+
+def pid_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+async def finish_job(job_id: str, update: Dict[str, Any]):
+    await db.jobs.update_one({"_id": job_id}, {"$set": {**update, "finishedAt": datetime.now(timezone.utc)}})
+
+async def load_job(job_id: str) -> Job:
+    """Fetch a job, marking it failed if the worker running it has stopped"""
+    doc = await db.jobs.find_one({"_id": job_id}, {**JOB_PROJECTION, "heartbeatAt": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if doc["status"] in ACTIVE_JOB_STATUSES and doc["heartbeatAt"] < datetime.now(timezone.utc) - JOB_STALE_AFTER:
+        await db.jobs.update_one(
+            {"_id": job_id, "status": doc["status"], "heartbeatAt": doc["heartbeatAt"]},
+            {"$set": {"status": JobStatus.FAILED.value, "error": "Interrupted: the worker running it stopped",
+                      "finishedAt": datetime.now(timezone.utc)}}
+        )
+        doc = await db.jobs.find_one({"_id": job_id}, JOB_PROJECTION)
+    return Job(**doc)
+
+def export_job(docs, fields: List[str], format: DataFormat, name: str):
+    async def run(context: JobContext):
+        rows = 0
+
+        async def counted():
+            nonlocal rows
+            async for doc in docs:
+                rows += 1
+                yield doc
+
+        async for text in export_rows(counted(), fields, format):
+            if text:
+                await context.write(text.encode())
+            await context.progress(rows)
+        await context.progress(rows, rows, force=True)
+        return {"rows": rows, "filename": f"{name}.{format.value}", "mediaType": EXPORT_MEDIA_TYPES[format]}
+    return run
+
+def build_job(job: JobCreate):
+    """Validate a job's parameters and build the coroutine function that runs it"""
+    # The rebuild and archiving take their leases themselves, so a job fails
+    # with a conflict instead of racing a run started elsewhere
+    try:
+        if job.kind == JobKind.REBUILD_ROLLUPS:
+            return {}, lambda context: rebuild_sales_rollups(progress=context.progress)
+        if job.kind == JobKind.ARCHIVE_SALES:
+            params = ArchiveJobParams(**job.params)
+            days = timedelta(days=params.days) if params.days else SALES_ARCHIVE_AFTER
+
+            async def archive(context: JobContext):
+                return {"archived": await archive_sales(datetime.now(timezone.utc) - days, progress=context.progress)}
+            return params.model_dump(), archive
+        if job.kind in (JobKind.EXPORT_PRODUCTS, JobKind.EXPORT_SALES):
+            params = ExportJobParams(**job.params)
+            if job.kind == JobKind.EXPORT_PRODUCTS:
+                run = export_job(product_export_docs(params.start, params.end), PRODUCT_EXPORT_FIELDS, params.format, "products")
+            else:
+                run = export_job(sale_export_docs(params.start, params.end), SALE_EXPORT_FIELDS, params.format, "sales")
+            return params.model_dump(mode="json"), run
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=validation_message(e))
+    raise HTTPException(status_code=400, detail="Upload the file to /api/jobs/import-products")
+
+@api_router.post("/jobs", response_model=Job, status_code=202)
+async def create_job(job: JobCreate):
+    """Queue a rollup rebuild, archiving run or export to run in the background"""
+    params, run = build_job(job)
+    return await job_runner.submit(job.kind, params, run)
+
+@api_router.post("/jobs/import-products", response_model=Job, status_code=202)
+async def create_import_job(file: UploadFile = File(...), format: Optional[DataFormat] = None):
+    """Queue a bulk product import; the report is the job's result"""
+    import_format = upload_format(file, format)
+    # The upload is gone once this request ends, so the job reads a copy
+    spooled = await run_in_threadpool(
+        tempfile.NamedTemporaryFile, prefix=f"{IMPORT_FILE_PREFIX}{os.getpid()}-", delete=False)
+    with spooled:
+        await run_in_threadpool(shutil.copyfileobj, file.file, spooled)
+
+    def discard():
+        os.unlink(spooled.name)
+
+    async def run(context: JobContext):
+        try:
+            with open(spooled.name, "rb") as source:
+                report = await import_product_file(source, import_format, progress=context.progress)
+            await context.progress(report.received, report.received, force=True)
+            return report.model_dump()
+        finally:
+            discard()
+
+    try:
+        return await job_runner.submit(
+            JobKind.IMPORT_PRODUCTS, {"format": import_format.value, "filename": file.filename}, run, discard)
+    except Exception:
+        discard()
+        raise
+
+@api_router.get("/jobs", response_model=List[Job])
+async def get_jobs(status: Optional[JobStatus] = None, kind: Optional[JobKind] = None,
+                   limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    """Most recent jobs first"""
+    query = {}
+    if status:
+        query["status"] = status.value
+    if kind:
+        query["kind"] = kind.value
+    jobs = await db.jobs.find(query, JOB_PROJECTION).sort("createdAt", -1).limit(limit).to_list(length=limit)
+    return FastJSONResponse(jobs)
+
+@api_router.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str):
+    return await load_job(job_id)
+
+@api_router.post("/jobs/{job_id}/cancel", response_model=Job)
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; finished jobs are left as they are"""
+    job = await load_job(job_id)
+    if job.status.value not in ACTIVE_JOB_STATUSES:
+        return job
+    await db.jobs.update_one({"_id": job_id}, {"$set": {"cancelRequested": True}})
+    # A queued job is cancelled here; a running one by the worker running it
+    await db.jobs.update_one(
+        {"_id": job_id, "status": JobStatus.QUEUED.value},
+        {"$set": {"status": JobStatus.CANCELLED.value, "finishedAt": datetime.now(timezone.utc)}}
+    )
+    job_runner.cancel(job_id)
+    return await load_job(job_id)
+
+@api_router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Download the output of a finished export job"""
+    job = await load_job(job_id)
+    if job.status != JobStatus.SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status.value}")
+    if not job.result or "filename" not in job.result:
+        raise HTTPException(status_code=404, detail="Job has no file to download")
+
+    async def chunks():
+        async for chunk in db.job_files.find({"jobId": job_id}, {"_id": 0, "data": 1}).sort("n", 1).batch_size(4):
+            yield chunk["data"]
+
+    return StreamingResponse(
+        chunks(),
+        media_type=job.result["mediaType"],
+        headers={"Content-Disposition": f'attachment; filename="{job.result["filename"]}"'}
     )
 
 # Health check
@@ -397,6 +2760,23 @@ async def detect_color(rgb_data: Dict[str, int]):
 async def root():
     return {"message": "Shawl Scan & Sales API is running!"}
 
+# Readiness check, outside /api: unlike the health check above it fails until
+# startup has finished and whenever the database stops answering. It is for
+# load balancers and deploy gating; platform liveness checks use /api, so a
+# database blip takes instances out of rotation instead of restarting them
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT", "2"))
+app_ready = False
+
+@app.get("/ready")
+async def readiness():
+    if not app_ready:
+        return FastJSONResponse({"status": "starting"}, status_code=503)
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), READINESS_TIMEOUT)
+    except Exception as e:
+        return FastJSONResponse({"status": "database unavailable", "error": str(e)}, status_code=503)
+    return {"status": "ready"}
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -406,7 +2786,10 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
+# Added last so it wraps everything else, CORS and error handling included
+app.add_middleware(metrics.MetricsMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -415,6 +2798,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Cross-worker cache sync
+# Each worker process caches products and color positions for the writes it
+# makes itself. To see the other workers' writes (and other instances'), it
+# polls the products changed since its last poll, using the same changedAt
+# stamps and tombstones as /api/products/changes.
+CACHE_SYNC_INTERVAL = float(os.environ.get("CACHE_SYNC_INTERVAL", "2"))
+
+async def sync_worker_caches():
+    """Apply product writes made by other processes to this worker's caches"""
+    since = datetime.now(timezone.utc)
+    while True:
+        await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        polled_at = datetime.now(timezone.utc)
+        query = {"changedAt": {"$gte": since - PRODUCT_SYNC_OVERLAP}}
+        try:
+            async for doc in db.products.find(query, PRODUCT_PROJECTION):
+                if doc["code"] in product_cache.entries:
+                    product_cache.put(Product(**doc))
+                color_index.upsert(doc["code"], doc["colorHex"], doc["stockQty"])
+            async for doc in db.product_tombstones.find(query, {"_id": 1}):
+                product_cache.invalidate(doc["_id"])
+                color_index.remove(doc["_id"])
+        except Exception as e:
+            logger.warning(f"Cache sync failed, retrying: {e}")
+            continue
+        since = polled_at
+
+async def start_app():
+    """Connect, then warm up: before serving in eager mode, in the background in lazy mode"""
+    with startup_phase("connect"):
+        connect_database()
+    if slow_query_log:
+        slow_query_log.attach(client, asyncio.get_running_loop())
+    await run_in_threadpool(remove_stale_import_files)
+    job_runner.start()
+    if STARTUP_MODE == "lazy":
+        # Nothing below is needed to serve a scan: the driver connects on the
+        # first query, color detection uses the rules until the lookup table is
+        # loaded, and the code sequence is seeded before the first code
+        run_in_background(warm_up_with_retries())
+    else:
+        await warm_up()
+
+async def warm_up_with_retries():
+    """Warm up in the background, retrying with backoff until it succeeds.
+
+    A sleeping database (e.g. an Atlas cluster resuming) can fail the first
+    attempts; giving up would leave the worker unready for its whole life.
+    """
+    delay = WARM_UP_RETRY_DELAY
+    while True:
+        try:
+            await warm_up()
+            return
+        except Exception as e:
+            logger.warning(f"Warm-up failed, retrying in {delay:g}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARM_UP_RETRY_MAX_DELAY)
+
+async def warm_up():
+    """Check the database answers and load everything the routes use"""
+    global app_ready
+    with startup_phase("ping"):
+        await client.admin.command("ping")
+    with startup_phase("indexes"):
+        await ensure_indexes()
+    with startup_phase("codeSequence"):
+        await product_code_block.ensure_prepared()
+    with startup_phase("colorIndex"):
+        await color_index.ensure_loaded()
+    # Build (or load the cached) color lookup table off the event loop
+    with startup_phase("colorTable"):
+        await run_in_threadpool(colors.load_color_lut)
+    run_in_background(migrate_datetimes())
+    # Documents written before search indexing get their terms in the
+    # background so a large sales history doesn't delay startup
+    run_in_background(backfill_search_terms())
+    if CACHE_SYNC_INTERVAL > 0:
+        run_in_background(sync_worker_caches())
+    if SALES_ARCHIVE_AFTER and SALES_ARCHIVE_INTERVAL > 0:
+        run_in_background(archive_sales_periodically())
+    app_ready = True
+    startup_timings["ready"] = startup_elapsed()
+    logger.info(f"Started ({STARTUP_MODE}): " + ", ".join(f"{phase} {ms}ms" for phase, ms in startup_timings.items()))
+
+async def stop_app():
+    global app_ready, color_pool
+    app_ready = False
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    job_runner.discard_queued()
+    if sale_coalescer:
+        await sale_coalescer.drain()
+    if color_pool:
+        color_pool.shutdown(wait=False, cancel_futures=True)
+        color_pool = None
+    client.close()
+
+startup_timings["import"] = startup_elapsed()
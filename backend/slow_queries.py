@@ -0,0 +1,176 @@
+"""Slow MongoDB query log.
+
+`SlowQueryLog` is a pymongo command listener: every command slower than the
+threshold is recorded with its filter shape (values replaced by "?"), its
+duration and the number of documents it returned, in a bounded ring buffer.
+Reads are then explained with executionStats in the background on the event
+loop, adding the winning plan's stages and the keys/documents examined, so
+collection scans show up as soon as the data outgrows an index.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Commands that carry a filter and can be explained without side effects
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"}
+# Fields of a command that describe what it does, as opposed to session,
+# cursor and connection details
+SHAPE_FIELDS = ("filter", "query", "q", "sort", "pipeline", "updates", "deletes", "key")
+# A hot slow query is explained once per interval, not on every execution
+EXPLAIN_INTERVAL = 60.0
+
+
+def plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Flatten an explain() winning plan into its stage names"""
+    stages = [plan.get("stage", "")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages += plan_stages(child)
+    return stages
+
+
+def winning_plan(query_planner: Dict[str, Any]) -> Dict[str, Any]:
+    # Newer servers wrap the plan produced by the slot-based engine
+    return query_planner["winningPlan"].get("queryPlan", query_planner["winningPlan"])
+
+
+def redact(value: Any) -> Any:
+    """Keep the operators and field names of a filter, drop its values"""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [redact(item) for item in value]
+        # A $in of 200 codes has the same shape as a $in of one
+        return shapes[:1] if all(shape == shapes[0] for shape in shapes) else shapes
+    return "?"
+
+
+def explain_summary(explanation: Dict[str, Any]) -> Dict[str, Any]:
+    """Stages and work done from an executionStats explain of any command"""
+    # Aggregations that were not pushed down entirely put the query part in
+    # their first stage
+    if "queryPlanner" not in explanation and explanation.get("stages"):
+        explanation = explanation["stages"][0].get("$cursor", {})
+    stats = explanation.get("executionStats", {})
+    stages = plan_stages(winning_plan(explanation["queryPlanner"])) if "queryPlanner" in explanation else []
+    return {
+        "stages": stages,
+        "collectionScan": "COLLSCAN" in stages,
+        "keysExamined": stats.get("totalKeysExamined"),
+        "docsExamined": stats.get("totalDocsExamined"),
+        "nReturned": stats.get("nReturned"),
+    }
+
+
+def returned_count(command_name: str, reply: Dict[str, Any]) -> Optional[int]:
+    if "cursor" in reply:
+        batch = reply["cursor"].get("firstBatch", reply["cursor"].get("nextBatch"))
+        return len(batch) if batch is not None else None
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    if command_name == "distinct":
+        return len(reply.get("values", []))
+    return reply.get("n")
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    """Ring buffer of commands slower than `threshold_ms`, with explain plans"""
+
+    def __init__(self, threshold_ms: float, size: int = 200):
+        self.threshold = threshold_ms / 1000
+        self.entries = deque(maxlen=size)
+        self.pending: Dict[Tuple, Tuple[str, Dict[str, Any]]] = {}
+        self.explained: Dict[Tuple, Tuple[float, Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+        self.tasks = set()
+        self.client = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def attach(self, client, loop: asyncio.AbstractEventLoop):
+        """Set the client and event loop the background explains run on"""
+        self.client = client
+        self.loop = loop
+
+    @staticmethod
+    def key(event) -> Tuple:
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE_COMMANDS or event.command_name == "getMore":
+            with self.lock:
+                self.pending[self.key(event)] = (event.database_name, event.command)
+
+    def succeeded(self, event):
+        self.finish(event, event.reply, None)
+
+    def failed(self, event):
+        self.finish(event, {}, event.failure.get("errmsg") if isinstance(event.failure, dict) else str(event.failure))
+
+    def finish(self, event, reply: Dict[str, Any], error: Optional[str]):
+        with self.lock:
+            started = self.pending.pop(self.key(event), None)
+        duration = event.duration_micros / 1e6
+        if started is None or duration < self.threshold:
+            return
+        database, command = started
+        target = command.get(event.command_name)
+        entry = {
+            "at": datetime.now(timezone.utc),
+            "database": database,
+            "collection": target if isinstance(target, str) else command.get("collection", ""),
+            "command": event.command_name,
+            "durationMs": round(duration * 1000, 2),
+            # Sort directions are part of the shape and carry no data
+            "shape": {field: command[field] if field == "sort" else redact(command[field])
+                      for field in SHAPE_FIELDS if field in command},
+            "returned": returned_count(event.command_name, reply),
+            "error": error,
+            "plan": None,
+        }
+        with self.lock:
+            self.entries.append(entry)
+        logger.warning("Slow query: %s.%s %s took %.1fms shape=%s", entry["collection"], entry["command"],
+                       database, entry["durationMs"], entry["shape"])
+        if event.command_name in EXPLAINABLE_COMMANDS and self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.schedule_explain, entry, command)
+
+    def schedule_explain(self, entry: Dict[str, Any], command: Dict[str, Any]):
+        shape_key = (entry["database"], entry["collection"], entry["command"], repr(entry["shape"]))
+        explained = self.explained.get(shape_key)
+        if explained and time.monotonic() - explained[0] < EXPLAIN_INTERVAL:
+            entry["plan"] = explained[1]
+            return
+        self.explained[shape_key] = (time.monotonic(), None)
+        task = asyncio.ensure_future(self.explain(entry, command, shape_key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def explain(self, entry: Dict[str, Any], command: Dict[str, Any], shape_key: Tuple):
+        # Drop session, read concern and cluster time fields the driver added
+        explained = {field: value for field, value in command.items()
+                     if not field.startswith("$") and field not in ("lsid", "txnNumber", "readConcern", "writeConcern")}
+        try:
+            explanation = await self.client[entry["database"]].command(
+                {"explain": explained, "verbosity": "executionStats"})
+            entry["plan"] = explain_summary(explanation)
+        except Exception as error:
+            entry["plan"] = {"error": str(error)}
+        self.explained[shape_key] = (time.monotonic(), entry["plan"])
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Recorded slow queries, newest first"""
+        with self.lock:
+            return list(reversed(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.explained.clear()
@@ -22,6 +22,11 @@ echo "✅ Environment variables verified"
 echo "🌍 Port: $PORT"
 echo "🗄️  Database: $DB_NAME"
 
+# One worker by default, as in render.yaml and the Dockerfile (nproc ignores
+# container CPU quotas); each worker has its own MongoDB pool and caches
+export WEB_CONCURRENCY=${WEB_CONCURRENCY:-1}
+echo "🧵 Workers: $WEB_CONCURRENCY"
+
 # Start the FastAPI server with uvicorn
 echo "🔥 Starting uvicorn server..."
-exec uvicorn server:app --host 0.0.0.0 --port $PORT --log-level info 
\ No newline at end of file
+exec uvicorn server:app --host 0.0.0.0 --port $PORT --workers $WEB_CONCURRENCY --log-level info 
\ No newline at end of file
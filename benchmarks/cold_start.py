@@ -0,0 +1,124 @@
+"""Cold start benchmark: time from launching the API process to its first scan.
+
+Each run starts a fresh interpreter that imports server, starts the app
+(lifespan included) against mongomock-motor holding one product, and serves
+GET /api/products/{code}. By default the color lookup table cache points at
+an empty directory, as on a freshly woken container.
+
+    python benchmarks/cold_start.py --mode lazy --runs 5
+    python benchmarks/cold_start.py --mode eager --budget-ms 5000
+
+Reports the median of each startup phase and of the total; exits 1 when the
+median total exceeds --budget-ms.
+"""
+import time
+
+LAUNCHED_CHILD = time.time()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+PRODUCT_CODE = "SH-0001"
+
+
+def probe():
+    """Child process: start the app and time the first product lookup"""
+    import asyncio
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    # Test harness only, not counted: the stand-in database and HTTP client
+    import httpx
+    from mongomock_motor import AsyncMongoMockClient
+
+    async def run():
+        server.client = AsyncMongoMockClient(tz_aware=True)
+        server.db = server.client["cold_start"]
+        await server.db.products.insert_one(server.product_document(server.Product(
+            code=PRODUCT_CODE, name="Pashmina shawl", colorName="red", colorHex="#aa1122",
+            price=120.0, category="wool", stockQty=3,
+        )))
+        started = time.perf_counter()
+        async with server.app.router.lifespan_context(server.app):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://cold-start") as client:
+                response = await client.get(f"/api/products/{PRODUCT_CODE}")
+            served = (time.perf_counter() - started) * 1000
+            print(json.dumps({
+                "status": response.status_code,
+                "launchedAt": LAUNCHED_CHILD,
+                "startAndFirstLookupMs": served,
+                "timings": server.startup_timings,
+            }), flush=True)
+            # Don't wait for the background warm-up to finish
+            os._exit(0)
+
+    asyncio.run(run())
+
+
+def run_once(mode: str, lut_path: str):
+    env = {**os.environ, "STARTUP_MODE": mode, "MONGO_URL": "mongodb://localhost:27017",
+           "DB_NAME": "cold_start", "COLOR_LUT_PATH": lut_path}
+    launched = time.time()
+    result = subprocess.run([sys.executable, __file__, "--probe"], env=env, capture_output=True, text=True, timeout=300)
+    lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    if result.returncode or not lines:
+        raise RuntimeError(f"Probe failed:\n{result.stdout}\n{result.stderr}")
+    report = json.loads(lines[-1])
+    if report["status"] != 200:
+        raise RuntimeError(f"First lookup returned {report['status']}")
+    phases = {
+        "interpreter": (report["launchedAt"] - launched) * 1000,
+        "import": report["timings"]["import"],
+        "startAndFirstLookup": report["startAndFirstLookupMs"],
+    }
+    phases["total"] = sum(phases.values())
+    return phases, report["timings"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["eager", "lazy"], default="lazy")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, help="fail when the median total exceeds this")
+    parser.add_argument("--warm-disk", action="store_true", help="keep the color table cached between runs")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.probe:
+        probe()
+        return
+
+    runs = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for index in range(args.runs):
+            lut_path = Path(scratch) / ("color-lut.npy" if args.warm_disk else f"color-lut-{index}.npy")
+            runs.append(run_once(args.mode, str(lut_path)))
+
+    medians = {phase: round(statistics.median(run[0][phase] for run in runs), 1) for phase in runs[0][0]}
+    server_phases = {phase: round(statistics.median(run[1].get(phase, 0) for run in runs), 1) for phase in runs[0][1]}
+    result = {"mode": args.mode, "runs": args.runs, "medianMs": medians, "serverPhasesMs": server_phases}
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"cold start ({args.mode}, median of {args.runs})")
+        for phase, ms in medians.items():
+            print(f"  {phase:<22} {ms:>9.1f} ms")
+        print("server phases")
+        for phase, ms in server_phases.items():
+            print(f"  {phase:<22} {ms:>9.1f} ms")
+    if args.budget_ms is not None and medians["total"] > args.budget_ms:
+        print(f"Cold start {medians['total']}ms exceeds the {args.budget_ms}ms budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
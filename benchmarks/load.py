@@ -0,0 +1,259 @@
+"""Load benchmark: drive the API in-process against a seeded local database.
+
+Starts server:app in-process (no network, no uvicorn) on mongomock-motor, or
+on a throwaway database of a local mongod with --mongo-url, seeds a catalogue
+and sales history, then runs each scenario with a fixed number of concurrent
+clients and reports p50/p95/p99 latency and throughput.
+
+    python benchmarks/load.py                          # run, compare to baseline.json if present
+    python benchmarks/load.py --save-baseline          # record this machine's baseline
+    python benchmarks/load.py --mongo-url mongodb://localhost:27017
+
+Exits with status 1 when a scenario returns errors or regresses past the
+baseline by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import httpx  # noqa: E402
+
+import colors  # noqa: E402
+import server  # noqa: E402
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+STYLES = ["Pashmina", "Kani", "Jamawar", "Sozni", "Tilla", "Aari", "Paisley", "Kashida"]
+KINDS = ["shawl", "stole", "wrap", "scarf", "dupatta"]
+# Background loops that run for the app's lifetime
+PERIODIC_TASKS = {"sync_worker_caches", "archive_sales_periodically", "run_jobs", "watch_jobs"}
+SCENARIOS = ["scan", "create_sale", "dashboard", "search_products", "search_sales", "detect_color"]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def random_product(rng: random.Random, number: int) -> server.Product:
+    r, g, b = rng.randrange(256), rng.randrange(256), rng.randrange(256)
+    return server.Product(
+        code=f"{server.PRODUCT_CODE_PREFIX}{number:04d}",
+        name=f"{rng.choice(STYLES)} {rng.choice(KINDS)} {number}",
+        colorName=colors.classify_rgb(r, g, b),
+        colorHex=f"#{r:02x}{g:02x}{b:02x}",
+        price=round(rng.uniform(15, 400), 2),
+        category=rng.choice(list(server.ProductCategory)),
+        stockQty=1_000_000,
+    )
+
+
+async def seed(rng: random.Random, product_count: int, sale_count: int, batch_size: int = 1000):
+    """Insert the catalogue and a 90-day sales history, with rollups"""
+    products = [random_product(rng, number) for number in range(1, product_count + 1)]
+    for start in range(0, len(products), batch_size):
+        await server.db.products.insert_many([server.product_document(p) for p in products[start:start + batch_size]])
+
+    now = datetime.now(timezone.utc)
+    for start in range(0, sale_count, batch_size):
+        sales = []
+        for _ in range(min(batch_size, sale_count - start)):
+            product = rng.choice(products).model_dump()
+            sale = server.sale_from_product(product, rng.randint(1, 3))
+            sale.timestamp = now - timedelta(seconds=rng.randrange(90 * 24 * 3600))
+            sales.append(sale)
+        await server.db.sales.insert_many([server.sale_document(sale) for sale in sales])
+        await server.record_sale_rollups(sales)
+    return [product.code for product in products]
+
+
+def scenario_requests(name: str, rng: random.Random, codes):
+    """Return a factory producing the (method, url, kwargs) of the next request"""
+    words = [word.lower() for word in STYLES]
+    if name == "scan":
+        # Scans concentrate on the shelf that is being worked, like at the counter
+        hot = codes[:max(1, len(codes) // 10)]
+        return lambda: ("GET", f"/api/products/{rng.choice(hot if rng.random() < 0.8 else codes)}", {})
+    if name == "create_sale":
+        return lambda: ("POST", "/api/sales", {"json": {"productCode": rng.choice(codes), "quantity": 1}})
+    if name == "dashboard":
+        return lambda: ("GET", "/api/dashboard/stats", {})
+    if name == "search_products":
+        return lambda: ("GET", "/api/products", {"params": {"search": rng.choice(words), "page_size": 50}})
+    if name == "search_sales":
+        return lambda: ("GET", "/api/sales", {"params": {"search": rng.choice(words), "page_size": 50}})
+    if name == "detect_color":
+        return lambda: ("POST", "/api/detect-color", {"json": {"r": rng.randrange(256), "g": rng.randrange(256), "b": rng.randrange(256)}})
+    raise ValueError(f"Unknown scenario {name}")
+
+
+async def run_scenario(client: httpx.AsyncClient, next_request, requests: int, concurrency: int):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, kwargs = next_request()
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1e3, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1e3, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1e3, 3),
+    }
+
+
+def compare(results, baseline, tolerance: float):
+    """List the regressions of `results` against `baseline`"""
+    failures = []
+    for name, result in results["scenarios"].items():
+        if result["errors"]:
+            failures.append(f"{name}: {result['errors']} failed requests")
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        if result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            failures.append(f"{name}: p95 {result['p95_ms']}ms vs baseline {previous['p95_ms']}ms")
+        if result["rps"] < previous["rps"] * (1 - tolerance):
+            failures.append(f"{name}: {result['rps']} req/s vs baseline {previous['rps']} req/s")
+    return failures
+
+
+def use_database(mongo_url):
+    """Point the server module at the benchmark database"""
+    if mongo_url:
+        bench_client = server.AsyncIOMotorClient(mongo_url, tz_aware=True)
+        database = bench_client[f"shawl_benchmark_{os.getpid()}"]
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        allow_partial_unique_indexes()
+        bench_client = AsyncMongoMockClient(tz_aware=True)
+        database = bench_client["shawl_benchmark"]
+    server.client, server.db = bench_client, database
+    return database
+
+
+def allow_partial_unique_indexes():
+    """Build {field: {"$exists": true}} partial indexes as sparse ones on mongomock.
+
+    mongomock ignores partialFilterExpression when it checks existing
+    documents for duplicates, so it can't build the sales idempotencyKey
+    index over seeded sales. A sparse index indexes the same documents.
+    """
+    import mongomock
+
+    create_index = mongomock.collection.Collection.create_index
+
+    def create_partial_as_sparse(self, key_or_list, session=None, **kwargs):
+        partial = kwargs.get("partialFilterExpression")
+        if partial and all(condition == {"$exists": True} for condition in partial.values()):
+            kwargs = {key: value for key, value in kwargs.items() if key != "partialFilterExpression"}
+            kwargs["sparse"] = True
+        return create_index(self, key_or_list, session=session, **kwargs)
+
+    mongomock.collection.Collection.create_index = create_partial_as_sparse
+
+
+async def benchmark(args):
+    rng = random.Random(args.seed)
+    database = use_database(args.mongo_url)
+    started = time.perf_counter()
+    codes = await seed(rng, args.products, args.sales)
+    print(f"seeded {args.products} products and {args.sales} sales in {time.perf_counter() - started:.1f}s")
+
+    results = {
+        "meta": {
+            "store": "mongod" if args.mongo_url else "mongomock",
+            "products": args.products,
+            "sales": args.sales,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        },
+        "scenarios": {},
+    }
+    transport = httpx.ASGITransport(app=server.app)
+    try:
+        async with server.app.router.lifespan_context(server.app):
+            # Let the startup backfills settle so they don't skew the first scenario
+            await asyncio.gather(*[task for task in server.background_tasks
+                                   if task.get_coro().__name__ not in PERIODIC_TASKS])
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+                for name in args.scenarios:
+                    next_request = scenario_requests(name, rng, codes)
+                    await run_scenario(client, next_request, min(args.warmup, args.requests), args.concurrency)
+                    results["scenarios"][name] = await run_scenario(client, next_request, args.requests, args.concurrency)
+                    print_result(name, results["scenarios"][name])
+    finally:
+        if args.mongo_url:
+            await database.client.drop_database(database.name)
+    return results
+
+
+def print_result(name, result):
+    print(f"{name:<16} {result['rps']:>9} req/s  p50 {result['p50_ms']:>8.2f}ms  "
+          f"p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms  errors {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--sales", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--mongo-url", help="benchmark against a local mongod instead of mongomock")
+    parser.add_argument("--output", type=Path, default=BENCHMARK_DIR / "results.json")
+    parser.add_argument("--baseline", type=Path, default=BENCHMARK_DIR / "baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95/throughput regression")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    results = asyncio.run(benchmark(args))
+    args.output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"results written to {args.output}")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"baseline written to {args.baseline}")
+        return
+    failures = compare(results, json.loads(args.baseline.read_text()) if args.baseline.exists() else {}, args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
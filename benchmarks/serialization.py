@@ -0,0 +1,106 @@
+"""Micro-benchmark: cost per row of serializing a product/sales list response.
+
+Compares the path list routes used to take (build a model per stored row,
+re-validate through response_model, encode with the stdlib json module) with
+the current one (projected rows straight to orjson). No database is needed.
+
+    python benchmarks/serialization.py --rows 1000 --repeat 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from bson import ObjectId  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import server  # noqa: E402
+
+
+def stored_products(n):
+    """Products as they come back from Mongo without a projection"""
+    now = datetime.now(timezone.utc)
+    return [{
+        "_id": ObjectId(),
+        "code": f"SH-{i:05d}",
+        "name": f"Pashmina shawl {i}",
+        "colorName": "red",
+        "colorHex": "#aa1122",
+        "price": 49.5 + i % 100,
+        "category": "wool",
+        "stockQty": i % 40,
+        "createdAt": now - timedelta(days=i % 365),
+        "updatedAt": now,
+        "searchTerms": ["pashmina", "shawl", str(i), f"sh-{i:05d}"],
+    } for i in range(n)]
+
+
+def stored_sales(n):
+    now = datetime.now(timezone.utc)
+    return [{
+        "_id": ObjectId(),
+        "id": str(uuid.uuid4()),
+        "productCode": f"SH-{i % 500:05d}",
+        "productName": f"Pashmina shawl {i % 500}",
+        "priceAtSale": 49.5,
+        "colorAtSale": "red (#aa1122)",
+        "timestamp": now - timedelta(minutes=i),
+        "quantity": 1 + i % 3,
+        "searchTerms": ["pashmina", "shawl"],
+    } for i in range(n)]
+
+
+def model_path(model, rows):
+    """Model per row, response_model validation + encoding, stdlib json"""
+    adapter = TypeAdapter(List[model])
+    objects = [model(**row) for row in rows]
+    content = adapter.dump_python(adapter.validate_python(objects), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def fast_path(model, rows):
+    """Projected rows straight to orjson"""
+    projection = [field for field in model.model_fields]
+    projected = [{field: row[field] for field in projection if field in row} for row in rows]
+    return server.FastJSONResponse(projected).body
+
+
+def measure(function, model, rows, repeat):
+    function(model, rows)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(model, rows)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'payload':<10} {'path':<8} {'total ms':>9} {'us/row':>8}")
+    for name, model, rows in (
+        ("products", server.Product, stored_products(args.rows)),
+        ("sales", server.Sale, stored_sales(args.rows)),
+    ):
+        before = measure(model_path, model, rows, args.repeat)
+        after = measure(fast_path, model, rows, args.repeat)
+        for label, seconds in (("model", before), ("fast", after)):
+            print(f"{name:<10} {label:<8} {seconds * 1e3:>9.2f} {seconds / len(rows) * 1e6:>8.2f}")
+        print(f"{name:<10} speedup  {before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,8 @@ const API = `${BACKEND_URL}/api`;
 const ProductsPage = () => {
   const [products, setProducts] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
   const [categoryFilter, setCategoryFilter] = useState(undefined);
 
@@ -23,20 +25,27 @@ const ProductsPage = () => {
     fetchProducts();
   }, [categoryFilter]);
 
-  const fetchProducts = async () => {
-    setLoading(true);
+  const fetchProducts = async (cursor = null) => {
+    if (cursor) {
+      setLoadingMore(true);
+    } else {
+      setLoading(true);
+    }
     try {
       const params = {};
       if (categoryFilter) params.category = categoryFilter;
       if (searchTerm) params.search = searchTerm;
+      if (cursor) params.cursor = cursor;
 
       const response = await axios.get(`${API}/products`, { params });
-      setProducts(response.data);
+      setProducts(prev => cursor ? [...prev, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Error loading products');
       console.error('Fetch products error:', error);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
@@ -225,6 +234,15 @@ const ProductsPage = () => {
           ))}
         </div>
       )}
+
+      {/* Pagination */}
+      {!loading && nextCursor && (
+        <div className="flex justify-center">
+          <Button variant="outline" onClick={() => fetchProducts(nextCursor)} disabled={loadingMore}>
+            {loadingMore ? 'Loading...' : 'Load more'}
+          </Button>
+        </div>
+      )}
     </div>
   );
 };
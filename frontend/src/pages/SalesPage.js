@@ -14,25 +14,34 @@ const API = `${BACKEND_URL}/api`;
 const SalesPage = () => {
   const [sales, setSales] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
 
   useEffect(() => {
     fetchSales();
   }, []);
 
-  const fetchSales = async () => {
-    setLoading(true);
+  const fetchSales = async (cursor = null) => {
+    if (cursor) {
+      setLoadingMore(true);
+    } else {
+      setLoading(true);
+    }
     try {
       const params = {};
       if (searchTerm) params.search = searchTerm;
+      if (cursor) params.cursor = cursor;
       
       const response = await axios.get(`${API}/sales`, { params });
-      setSales(response.data);
+      setSales(prev => cursor ? [...prev, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Error loading sales');
       console.error('Fetch sales error:', error);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
@@ -94,7 +103,7 @@ const SalesPage = () => {
           <p className="text-slate-600">Track all product sales and transactions</p>
         </div>
         <div className="flex gap-2">
-          <Button onClick={fetchSales} variant="outline">
+          <Button onClick={() => fetchSales()} variant="outline">
             <RefreshCw className="w-4 h-4 mr-2" />
             Refresh
           </Button>
@@ -192,6 +201,15 @@ const SalesPage = () => {
           ))}
         </div>
       )}
+
+      {/* Pagination */}
+      {!loading && nextCursor && (
+        <div className="flex justify-center">
+          <Button variant="outline" onClick={() => fetchSales(nextCursor)} disabled={loadingMore}>
+            {loadingMore ? 'Loading...' : 'Load more'}
+          </Button>
+        </div>
+      )}
     </div>
   );
 };
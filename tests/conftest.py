@@ -0,0 +1,76 @@
+"""Shared fixtures. The tests run the backend in-process on mongomock-motor.
+
+Each test gets a fresh database and fresh module-level state (caches, code
+sequence, coalescer), restored by monkeypatch afterwards, so tests don't see
+each other's products, cached stats or reserved codes. A test module that
+defines STOCK, a stock level per product code, gets those products seeded
+before each of its tests.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "shop_inventory_test")
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """A fresh mongomock database behind the server module"""
+    pytest.importorskip("mongomock_motor")
+    from mongomock_motor import AsyncMongoMockClient
+    import server
+
+    client = AsyncMongoMockClient(tz_aware=True)
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", client[os.environ["DB_NAME"]])
+    monkeypatch.setattr(server, "sale_coalescer", None)
+    monkeypatch.setattr(server, "rollup_rebuild_checked", (float("-inf"), False))
+    monkeypatch.setattr(server, "product_codes_unique", False)
+    monkeypatch.setattr(server, "product_cache", server.ProductCache(server.PRODUCT_CACHE_SIZE, server.PRODUCT_CACHE_TTL))
+    monkeypatch.setattr(server, "dashboard_cache", server.DashboardCache(server.DASHBOARD_CACHE_TTL))
+    monkeypatch.setattr(server, "color_index", server.ColorIndex(server.COLOR_INDEX_MAX_AGE))
+    monkeypatch.setattr(server, "product_code_block", server.SequenceBlock(
+        server.PRODUCT_CODE_SEQUENCE, server.PRODUCT_CODE_BLOCK_SIZE, prepare=server.seed_product_code_sequence))
+    return server.db
+
+
+@pytest.fixture
+def seed_products(database):
+    """Insert a shawl for each code, with the given stock level"""
+    import server
+
+    def seed(stock):
+        async def insert():
+            await database.products.insert_many([
+                server.product_document(server.Product(
+                    code=code, name=f"Kani shawl {code}", colorName="red", colorHex="#aa1122",
+                    price=50.0, category="wool", stockQty=quantity,
+                ))
+                for code, quantity in stock.items()
+            ])
+
+        asyncio.run(insert())
+
+    return seed
+
+
+@pytest.fixture(autouse=True)
+def products(request):
+    """Seed the test module's STOCK, if it has one"""
+    stock = getattr(request.module, "STOCK", None)
+    if stock is not None:
+        request.getfixturevalue("seed_products")(stock)
+
+
+@pytest.fixture
+def stock_levels(database):
+    """Read every product's stock level, by code"""
+    async def read():
+        return {doc["code"]: doc["stockQty"] async for doc in database.products.find({}, {"_id": 0, "code": 1, "stockQty": 1})}
+
+    return read
@@ -0,0 +1,94 @@
+"""Multi-item checkout: a cart is recorded whole or not at all, and stock is
+only ever taken for lines that stay recorded.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+from fastapi import HTTPException  # noqa: E402
+from pymongo.errors import AutoReconnect, BulkWriteError  # noqa: E402
+
+import server  # noqa: E402
+
+STOCK = {"SH-0001": 10, "SH-0002": 5, "SH-0003": 1}
+
+
+def cart(*items):
+    return server.CheckoutRequest(items=[server.SaleCreate(productCode=code, quantity=quantity) for code, quantity in items])
+
+
+def checkout(database, stock_levels, items):
+    async def run():
+        try:
+            outcome = await server.checkout(cart(*items))
+        except HTTPException as e:
+            outcome = e
+        return outcome, await stock_levels(), await database.sales.count_documents({})
+
+    return asyncio.run(run())
+
+
+def test_cart_takes_stock_for_every_line(database, stock_levels):
+    sales, stock, recorded = checkout(database, stock_levels, [("SH-0001", 2), ("SH-0002", 1), ("SH-0001", 1)])
+    assert [sale.productCode for sale in sales] == ["SH-0001", "SH-0002", "SH-0001"]
+    assert stock == {"SH-0001": 7, "SH-0002": 4, "SH-0003": 1}
+    assert recorded == 3
+
+
+@pytest.mark.parametrize("items, status", [
+    ([("SH-0001", 2), ("SH-0003", 2), ("SH-0002", 1)], 400),
+    ([("SH-0001", 2), ("SH-9999", 1)], 404),
+])
+def test_failing_line_rolls_back_the_cart(database, stock_levels, items, status):
+    error, stock, recorded = checkout(database, stock_levels, items)
+    assert error.status_code == status
+    assert stock == STOCK
+    assert recorded == 0
+
+
+def test_partial_insert_rolls_back_the_cart(database, stock_levels, monkeypatch):
+    insert_many = type(database.sales).insert_many
+
+    async def failing_after_first(self, docs, *args, **kwargs):
+        # What an ordered insert does when its second document fails
+        await insert_many(self, docs[:1], *args, **kwargs)
+        raise BulkWriteError({"nInserted": 1, "writeErrors": [{"index": 1, "code": 121, "errmsg": "validation failed"}]})
+
+    monkeypatch.setattr(type(database.sales), "insert_many", failing_after_first)
+
+    error, stock, recorded = checkout(database, stock_levels, [("SH-0001", 2), ("SH-0002", 1), ("SH-0003", 1)])
+    assert error.status_code == 400
+    assert stock == STOCK
+    assert recorded == 0
+
+
+def test_failed_stock_update_rolls_back_the_cart(database, stock_levels, monkeypatch):
+    take_product_stock = server.take_product_stock
+
+    async def flaky_take_product_stock(code, quantity):
+        if code == "SH-0002":
+            raise AutoReconnect("connection reset")
+        return await take_product_stock(code, quantity)
+
+    monkeypatch.setattr(server, "take_product_stock", flaky_take_product_stock)
+
+    async def run():
+        with pytest.raises(AutoReconnect):
+            await server.checkout(cart(("SH-0001", 3), ("SH-0002", 1)))
+        return await stock_levels(), await database.sales.count_documents({})
+
+    stock, recorded = asyncio.run(run())
+    assert stock == STOCK
+    assert recorded == 0
+
+
+def test_rolled_back_cart_leaves_color_stock_flags_matching_the_database(database):
+    async def run():
+        await server.color_index.ensure_loaded()
+        # SH-0003's only unit is taken, then put back when SH-0002 is short
+        with pytest.raises(HTTPException):
+            await server.checkout(cart(("SH-0003", 1), ("SH-0002", 6)))
+        return {code: bool(server.color_index.in_stock[row]) for code, row in server.color_index.rows.items()}
+
+    assert asyncio.run(run()) == {code: quantity > 0 for code, quantity in STOCK.items()}
@@ -0,0 +1,32 @@
+"""Cold start budget: launching the API to its first successful product lookup.
+
+Runs benchmarks/cold_start.py in lazy startup mode (what scale-to-zero
+deployments use) with an empty color table cache, and fails when the median
+time exceeds COLD_START_BUDGET_MS.
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+pytest.importorskip("httpx")
+
+ROOT = Path(__file__).resolve().parent.parent
+BUDGET_MS = float(os.environ.get("COLD_START_BUDGET_MS", "2000"))
+
+
+def test_lazy_cold_start_is_within_budget():
+    result = subprocess.run(
+        [sys.executable, str(ROOT / "benchmarks" / "cold_start.py"),
+         "--mode", "lazy", "--runs", "3", "--budget-ms", str(BUDGET_MS), "--json"],
+        capture_output=True, text=True, timeout=300,
+    )
+    assert result.returncode == 0, result.stderr + result.stdout
+    report = json.loads(result.stdout.splitlines()[-1])
+    # Lazy mode must not put the database or color table warm-up on the path
+    assert "colorTable" not in report["serverPhasesMs"]
+    assert report["medianMs"]["total"] <= BUDGET_MS
@@ -0,0 +1,81 @@
+"""Keyset pagination: following X-Next-Cursor visits every row exactly once, in
+order, including sales sharing a timestamp and sales continuing into the
+archive.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+
+pytest.importorskip("mongomock_motor")
+import server  # noqa: E402
+
+
+async def all_pages(list_route, **params):
+    """Call a list route page by page; return every page's rows"""
+    pages = []
+    cursor = None
+    while True:
+        response = await list_route(cursor=cursor, **params)
+        pages.append(orjson.loads(response.body))
+        cursor = response.headers.get(server.NEXT_CURSOR_HEADER)
+        if not cursor:
+            return pages
+
+
+def test_product_pages_cover_the_catalogue_once(seed_products):
+    codes = [f"SH-{n:04d}" for n in range(1, 24)]
+    seed_products({code: 1 for code in codes})
+
+    pages = asyncio.run(all_pages(server.get_products, category=None, search=None, page_size=5))
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    assert [product["code"] for page in pages for product in page] == codes
+
+
+def sales_at(timestamps):
+    return [
+        server.Sale(productCode="SH-0001", productName="Kani shawl", priceAtSale=50.0,
+                    colorAtSale="red (#aa1122)", timestamp=timestamp)
+        for timestamp in timestamps
+    ]
+
+
+def assert_listed_once_in_order(pages, sales):
+    listed = [sale["id"] for page in pages for sale in page]
+    expected = [sale.id for sale in sorted(sales, key=lambda sale: (sale.timestamp, sale.id), reverse=True)]
+    assert listed == expected
+    assert all(len(page) == 4 for page in pages[:-1])
+
+
+def test_sale_pages_continue_into_the_archive_without_gaps_or_overlap(database):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    # Recent and archived sales, several sharing a timestamp in each tier
+    sales = sales_at([now - timedelta(minutes=n // 3) for n in range(10)]
+                     + [now - timedelta(days=400 + n // 4) for n in range(13)])
+
+    async def run():
+        await database.sales.insert_many([server.sale_document(sale) for sale in sales])
+        archived = await server.archive_sales(now - server.SALES_ARCHIVE_AFTER)
+        return archived, await all_pages(server.get_sales, search=None, page_size=4, limit=None)
+
+    archived, pages = asyncio.run(run())
+    assert archived == 13
+    assert_listed_once_in_order(pages, sales)
+
+
+def test_sales_synced_late_are_paged_among_archived_ones(database):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    archived = sales_at([now - timedelta(days=400 + n) for n in range(9)])
+    # Recorded after the archiving run, with the till's old timestamps: they
+    # stay in db.sales, older than most archived sales
+    late = sales_at([now - timedelta(days=403, hours=12), now - timedelta(days=404), now - timedelta(days=420)])
+    recent = sales_at([now - timedelta(minutes=n) for n in range(3)])
+
+    async def run():
+        await database.sales.insert_many([server.sale_document(sale) for sale in archived])
+        await server.archive_sales(now - server.SALES_ARCHIVE_AFTER)
+        await database.sales.insert_many([server.sale_document(sale) for sale in late + recent])
+        return await all_pages(server.get_sales, search=None, page_size=4, limit=None)
+
+    assert_listed_once_in_order(asyncio.run(run()), archived + late + recent)
@@ -0,0 +1,75 @@
+"""Product delta sync: changes since a token include updates, new products and
+deletions, and a token too old for the tombstones gets the full catalogue.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+
+pytest.importorskip("mongomock_motor")
+from fastapi import HTTPException  # noqa: E402
+
+import server  # noqa: E402
+
+STOCK = {code: 5 for code in ["SH-0001", "SH-0002", "SH-0003"]}
+CODES = list(STOCK)
+
+
+@pytest.fixture(autouse=True)
+def no_sync_overlap(monkeypatch):
+    # Without the overlap, a sync returns exactly what changed after the token
+    monkeypatch.setattr(server, "PRODUCT_SYNC_OVERLAP", timedelta(0))
+
+
+async def changes(since=None):
+    return orjson.loads((await server.get_product_changes(since)).body)
+
+
+def test_changes_since_a_token_include_deletions(database):
+    async def run():
+        full = await changes()
+        await asyncio.sleep(0.01)
+        await server.update_product("SH-0001", server.ProductUpdate(price=60.0))
+        await server.delete_product("SH-0002")
+        await server.create_product(server.ProductCreate(
+            name="Pashmina", colorName="blue", colorHex="#1122aa", price=80.0, category="cashmere"))
+        await server.create_sale(server.SaleCreate(productCode="SH-0003", quantity=1))
+        return full, await changes(full["token"])
+
+    full, delta = asyncio.run(run())
+    assert full["reset"] is True
+    assert [product["code"] for product in full["changed"]] == CODES
+    assert delta["reset"] is False
+    assert [product["code"] for product in delta["changed"]] == ["SH-0001", "SH-0003", "SH-0004"]
+    assert delta["removed"] == ["SH-0002"]
+
+
+def test_recreated_product_is_no_longer_removed(database):
+    async def run():
+        token = (await changes())["token"]
+        await asyncio.sleep(0.01)
+        await server.delete_product("SH-0002")
+        await server.create_product(server.ProductCreate(
+            code="SH-0002", name="Kani shawl", colorName="red", colorHex="#aa1122", price=50.0, category="wool"))
+        return await changes(token)
+
+    delta = asyncio.run(run())
+    assert [product["code"] for product in delta["changed"]] == ["SH-0002"]
+    assert delta["removed"] == []
+
+
+def test_token_older_than_the_tombstones_resets(database):
+    expired = server.encode_cursor({"changedAt": datetime.now(timezone.utc) - 2 * server.PRODUCT_TOMBSTONE_RETENTION})
+
+    delta = asyncio.run(changes(expired))
+    assert delta["reset"] is True
+    assert [product["code"] for product in delta["changed"]] == CODES
+
+
+@pytest.mark.parametrize("since", ["not-a-token", server.encode_cursor({"changedAt": 5}),
+                                   server.encode_cursor({"changedAt": "yesterday"})])
+def test_invalid_token_is_rejected(database, since):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(changes(since))
+    assert error.value.status_code == 400
@@ -0,0 +1,101 @@
+"""Offline sale sync: a retried batch records nothing twice, and stock taken
+for sales that end up not recorded is put back.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+from pymongo.errors import AutoReconnect  # noqa: E402
+
+import server  # noqa: E402
+
+STOCK = {"SH-0001": 10, "SH-0002": 1}
+
+
+def sync_request(*sales, timestamp=None):
+    return server.SaleSyncRequest(sales=[
+        server.QueuedSale(idempotencyKey=key, productCode=code, quantity=quantity, timestamp=timestamp)
+        for key, code, quantity in sales
+    ])
+
+
+def statuses(results):
+    return [result.status.value for result in results]
+
+
+def test_replayed_batch_records_nothing_twice(database, stock_levels):
+    batch = sync_request(("k1", "SH-0001", 2), ("k2", "SH-0002", 1), ("k3", "SH-0002", 1), ("k1", "SH-0001", 2))
+
+    async def run():
+        first = await server.sync_sales(batch)
+        replayed = await server.sync_sales(batch)
+        totals = await database.sales_totals.find_one({"_id": server.ROLLUP_ALL_TIME})
+        return first, replayed, await stock_levels(), await database.sales.count_documents({}), totals
+
+    first, replayed, stock, recorded, totals = asyncio.run(run())
+    assert statuses(first) == ["recorded", "recorded", "rejected", "duplicate"]
+    assert statuses(replayed) == ["duplicate", "duplicate", "rejected", "duplicate"]
+    assert [result.sale.id for result in replayed[:2]] == [result.sale.id for result in first[:2]]
+    assert stock == {"SH-0001": 8, "SH-0002": 0}
+    assert recorded == 2
+    assert totals["units"] == 3
+
+
+def test_replay_after_archiving_records_nothing_twice(database, stock_levels):
+    # Queued long ago by the till's clock, so archived soon after the first sync
+    batch = sync_request(("k1", "SH-0001", 2), timestamp=datetime.now(timezone.utc) - timedelta(days=400))
+
+    async def run():
+        first = await server.sync_sales(batch)
+        await server.archive_sales(datetime.now(timezone.utc) - server.SALES_ARCHIVE_AFTER)
+        replayed = await server.sync_sales(batch)
+        return first, replayed, await stock_levels(), await database.sales.count_documents({})
+
+    first, replayed, stock, recorded = asyncio.run(run())
+    assert statuses(replayed) == ["duplicate"]
+    assert replayed[0].sale.id == first[0].sale.id
+    assert stock["SH-0001"] == 8
+    assert recorded == 0
+
+
+def test_failed_stock_update_fails_only_that_products_sales(database, stock_levels, monkeypatch):
+    take_product_stock = server.take_product_stock
+
+    async def flaky_take_product_stock(code, quantity):
+        if code == "SH-0002":
+            raise AutoReconnect("connection reset")
+        return await take_product_stock(code, quantity)
+
+    monkeypatch.setattr(server, "take_product_stock", flaky_take_product_stock)
+
+    async def run():
+        results = await server.sync_sales(sync_request(("k1", "SH-0001", 2), ("k2", "SH-0002", 1)))
+        return results, await stock_levels()
+
+    results, stock = asyncio.run(run())
+    assert statuses(results) == ["recorded", "rejected"]
+    assert stock == {"SH-0001": 8, "SH-0002": 1}
+
+
+def test_failure_after_taking_stock_puts_it_back(database, stock_levels, monkeypatch):
+    find = type(database.products).find
+
+    def failing_product_find(self, *args, **kwargs):
+        if self.name == "products":
+            raise AutoReconnect("connection reset")
+        return find(self, *args, **kwargs)
+
+    # The unknown code makes sync_sales look products up after taking SH-0001's stock
+    monkeypatch.setattr(type(database.products), "find", failing_product_find)
+
+    async def run():
+        with pytest.raises(AutoReconnect):
+            await server.sync_sales(sync_request(("k1", "SH-0001", 2), ("k2", "SH-9999", 1)))
+        monkeypatch.setattr(type(database.products), "find", find)
+        return await stock_levels(), await database.sales.count_documents({})
+
+    stock, recorded = asyncio.run(run())
+    assert stock == STOCK
+    assert recorded == 0
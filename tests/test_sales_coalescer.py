@@ -0,0 +1,54 @@
+"""Coalesced single sales: each sale in a batch gets its own result and stock
+is only ever taken for sales that are recorded.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+from pymongo.errors import AutoReconnect  # noqa: E402
+
+import server  # noqa: E402
+
+STOCK = {"SH-0001": 100, "SH-0002": 3, "SH-0003": 0}
+
+
+async def submit_all(sales):
+    coalescer = server.SaleCoalescer(window=0.005, max_batch=100)
+    return await asyncio.gather(
+        *(coalescer.submit(server.SaleCreate(productCode=code, quantity=quantity)) for code, quantity in sales),
+        return_exceptions=True,
+    )
+
+
+def status(result):
+    return 200 if isinstance(result, server.Sale) else getattr(result, "status_code", None)
+
+
+def test_batch_gives_each_sale_its_own_result(database, stock_levels):
+    sales = [("SH-0001", 2), ("SH-0002", 2), ("SH-0002", 2), ("SH-0003", 1), ("SH-9999", 1), ("SH-0001", 1)]
+
+    async def run():
+        results = await submit_all(sales)
+        return results, await stock_levels(), await database.sales.count_documents({})
+
+    results, stock, recorded = asyncio.run(run())
+    # The second SH-0002 sale doesn't fit in what the first one left
+    assert [status(result) for result in results] == [200, 200, 400, 400, 404, 200]
+    assert stock == {"SH-0001": 97, "SH-0002": 1, "SH-0003": 0}
+    assert recorded == 3
+
+
+def test_failed_insert_puts_the_stock_back(database, stock_levels, monkeypatch):
+    async def failing_insert_many(self, *args, **kwargs):
+        raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(type(database.sales), "insert_many", failing_insert_many)
+
+    async def run():
+        results = await submit_all([("SH-0001", 2), ("SH-0002", 1), ("SH-0003", 1)])
+        return results, await stock_levels()
+
+    results, stock = asyncio.run(run())
+    assert all(isinstance(result, AutoReconnect) for result in results)
+    assert stock == STOCK